@@ -3,22 +3,611 @@
 """Utility functions for calculating edits."""
 
 import bisect
+import copy
 import difflib
+import functools
+import io
+import itertools
+import re
+import tokenize
+from collections import Counter
 from threading import Thread
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 
 from lsprotocol import types as lsp
 
 DIFF_TIMEOUT = 1  # 1 second
 
+# Lines that start a logical line when found at column 0.
+LOGICAL_LINE_ANCHORS = ("def ", "class ", "async def ", "@", "import ", "from ")
 
-def _get_diff(old_text: str, new_text: str):
+
+def get_logical_line(
+    lines: Sequence[str], line: int, max_lines: int = 200
+) -> Optional[Tuple[int, int]]:
+    """Return zero based `(start, end)` lines of the logical line ending on `line`.
+
+    Only the lines from the closest top level definition or import are
+    tokenized, so the cost does not depend on the size of the document. Returns
+    None if `line` does not end a complete logical line.
+    """
+    anchor = line
+    while anchor > 0 and not lines[anchor].startswith(LOGICAL_LINE_ANCHORS):
+        if line - anchor >= max_lines:
+            return None
+        anchor -= 1
+
+    start = None
+    readline = io.StringIO("".join(lines[anchor : line + 1])).readline
+    try:
+        for token in tokenize.generate_tokens(readline):
+            if token.type == tokenize.ERRORTOKEN:
+                return None
+            if token.type == tokenize.NEWLINE:
+                if start is not None and anchor + token.start[0] - 1 == line:
+                    return start, line
+                start = None
+            elif start is None and token.type not in (
+                tokenize.NL,
+                tokenize.COMMENT,
+                tokenize.INDENT,
+                tokenize.DEDENT,
+                tokenize.ENDMARKER,
+            ):
+                start = anchor + token.start[0] - 1
+    except (tokenize.TokenError, SyntaxError):
+        pass
+    return None
+
+
+def select_line_ranges(
+    old_text: str,
+    new_text: str,
+    line_ranges: Sequence[Tuple[int, int]],
+    old_index: Optional["LineIndex"] = None,
+) -> str:
+    """Return old_text with only the changes from new_text that fall in line_ranges.
+
+    Each line range is a `(start, end)` pair of zero based, inclusive line numbers
+    in old_text. Lines are aligned ignoring whitespace, so a line that was only
+    re-spaced is matched with its formatted version. Blocks of changed lines that
+    are not fully inside a range are kept as they are in old_text. old_index, if
+    given, must be the index of old_text.
+    """
+    if old_index is not None and old_index.size == len(old_text):
+        old_lines = old_index.lines
+    else:
+        old_lines = old_text.splitlines(True)
+    new_lines = new_text.splitlines(True)
+
+    def in_ranges(start: int, end: int) -> bool:
+        return any(first <= start and end <= last for first, last in line_ranges)
+
+    lines = []
+    matcher = difflib.SequenceMatcher(
+        a=["".join(line.split()) for line in old_lines],
+        b=["".join(line.split()) for line in new_lines],
+        autojunk=False,
+    )
+    for opcode, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+        if opcode == "equal":
+            for old_line, new_line in zip(
+                range(old_start, old_end), range(new_start, new_end)
+            ):
+                if in_ranges(old_line, old_line):
+                    lines.append(new_lines[new_line])
+                else:
+                    lines.append(old_lines[old_line])
+        elif in_ranges(old_start, max(old_start, old_end - 1)):
+            lines.extend(new_lines[new_start:new_end])
+        else:
+            lines.extend(old_lines[old_start:old_end])
+    return "".join(lines)
+
+
+Opcode = Tuple[str, int, int, int, int]
+DiffBackend = Callable[[str, str], List[Opcode]]
+
+# Largest hunk, in characters, diffed character by character with difflib.
+CHARACTER_DIFF_MAX_SIZE = 2000
+# Largest hunk, in characters, diffed character by character with Levenshtein.
+LEVENSHTEIN_DIFF_MAX_SIZE = 20000
+# Largest hunk, in characters, diffed token by token. Larger hunks are
+# replaced line by line.
+TOKEN_DIFF_MAX_SIZE = 100000
+# Largest estimated lines times changed lines for which the Myers line diff is
+# used, above this the patience line diff is faster.
+MYERS_DIFF_MAX_COST = 1000000
+
+TOKEN_SPLIT_PATTERN = re.compile(r"\w+|\s+|[^\w\s]+")
+
+# Line breaks recognized by `str.splitlines`.
+LINE_BREAKS = "\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029"
+LINE_BREAK_PATTERN = re.compile(f"\r\n|[{LINE_BREAKS}]")
+
+# Kinds of lines, by the characters they contain.
+ASCII_LINE = 0
+BMP_LINE = 1
+ASTRAL_LINE = 2
+
+
+def _get_tag(old_start: int, old_end: int, new_start: int, new_end: int) -> str:
+    if old_start < old_end and new_start < new_end:
+        return "replace"
+    return "delete" if old_start < old_end else "insert"
+
+
+def _get_opcodes(
+    matches: Sequence[Tuple[int, int]], old_size: int, new_size: int
+) -> List[Opcode]:
+    """Return difflib style opcodes for a sorted list of matching indexes."""
+    opcodes: List[Opcode] = []
+    old_start = new_start = 0
+    for old_index, new_index in matches:
+        if old_start < old_index or new_start < new_index:
+            tag = _get_tag(old_start, old_index, new_start, new_index)
+            opcodes.append((tag, old_start, old_index, new_start, new_index))
+        if opcodes and opcodes[-1][0] == "equal":
+            _, old_equal, _, new_equal, _ = opcodes[-1]
+            opcodes[-1] = ("equal", old_equal, old_index + 1, new_equal, new_index + 1)
+        else:
+            opcodes.append(("equal", old_index, old_index + 1, new_index, new_index + 1))
+        old_start, new_start = old_index + 1, new_index + 1
+    if old_start < old_size or new_start < new_size:
+        tag = _get_tag(old_start, old_size, new_start, new_size)
+        opcodes.append((tag, old_start, old_size, new_start, new_size))
+    return opcodes
+
+
+def _myers_opcodes(old: Sequence[str], new: Sequence[str]) -> List[Opcode]:
+    """Return opcodes from the Myers O(ND) shortest edit script."""
+    old_size, new_size = len(old), len(new)
+    frontier = {1: 0}
+    trace = []
+    for distance in range(old_size + new_size + 1):
+        trace.append(frontier.copy())
+        for diagonal in range(-distance, distance + 1, 2):
+            if diagonal == -distance or (
+                diagonal != distance
+                and frontier[diagonal - 1] < frontier[diagonal + 1]
+            ):
+                x = frontier[diagonal + 1]
+            else:
+                x = frontier[diagonal - 1] + 1
+            y = x - diagonal
+            while x < old_size and y < new_size and old[x] == new[y]:
+                x, y = x + 1, y + 1
+            frontier[diagonal] = x
+            if x >= old_size and y >= new_size:
+                break
+        else:
+            continue
+        break
+
+    matches = []
+    x, y = old_size, new_size
+    for distance in range(len(trace) - 1, -1, -1):
+        frontier = trace[distance]
+        diagonal = x - y
+        if diagonal == -distance or (
+            diagonal != distance and frontier[diagonal - 1] < frontier[diagonal + 1]
+        ):
+            previous = diagonal + 1
+        else:
+            previous = diagonal - 1
+        previous_x = frontier[previous]
+        previous_y = previous_x - previous
+        while x > previous_x and y > previous_y:
+            x, y = x - 1, y - 1
+            matches.append((x, y))
+        x, y = previous_x, previous_y
+    matches.reverse()
+    return _get_opcodes(matches, old_size, new_size)
+
+
+def _longest_increasing_run(anchors: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Return the longest run of anchors increasing in both indexes."""
+    tails: List[int] = []
+    tail_indexes: List[int] = []
+    previous = [-1] * len(anchors)
+    for index, (_, new_index) in enumerate(anchors):
+        position = bisect.bisect_left(tails, new_index)
+        if position > 0:
+            previous[index] = tail_indexes[position - 1]
+        if position == len(tails):
+            tails.append(new_index)
+            tail_indexes.append(index)
+        else:
+            tails[position] = new_index
+            tail_indexes[position] = index
+
+    run = []
+    index = tail_indexes[-1] if tail_indexes else -1
+    while index >= 0:
+        run.append(anchors[index])
+        index = previous[index]
+    run.reverse()
+    return run
+
+
+def _patience_opcodes(old: Sequence[str], new: Sequence[str]) -> List[Opcode]:
+    """Return opcodes from a patience diff.
+
+    Items that occur exactly once on both sides anchor the diff, and the
+    blocks between anchors are diffed the same way. Blocks without unique
+    items fall back to difflib.
+    """
+    matches = []
+    blocks = [(0, len(old), 0, len(new))]
+    while blocks:
+        old_start, old_end, new_start, new_end = blocks.pop()
+        while (
+            old_start < old_end
+            and new_start < new_end
+            and old[old_start] == new[new_start]
+        ):
+            matches.append((old_start, new_start))
+            old_start, new_start = old_start + 1, new_start + 1
+        while (
+            old_start < old_end
+            and new_start < new_end
+            and old[old_end - 1] == new[new_end - 1]
+        ):
+            old_end, new_end = old_end - 1, new_end - 1
+            matches.append((old_end, new_end))
+        if old_start == old_end or new_start == new_end:
+            continue
+
+        old_counts = Counter(old[old_start:old_end])
+        new_counts = Counter(new[new_start:new_end])
+        new_indexes = {
+            new[index]: index
+            for index in range(new_start, new_end)
+            if new_counts[new[index]] == 1
+        }
+        anchors = _longest_increasing_run(
+            [
+                (index, new_indexes[old[index]])
+                for index in range(old_start, old_end)
+                if old_counts[old[index]] == 1 and old[index] in new_indexes
+            ]
+        )
+        if not anchors:
+            matcher = difflib.SequenceMatcher(
+                a=old[old_start:old_end], b=new[new_start:new_end], autojunk=False
+            )
+            for old_index, new_index, size in matcher.get_matching_blocks():
+                for offset in range(size):
+                    matches.append(
+                        (old_start + old_index + offset, new_start + new_index + offset)
+                    )
+            continue
+
+        matches.extend(anchors)
+        for old_index, new_index in anchors:
+            blocks.append((old_start, old_index, new_start, new_index))
+            old_start, new_start = old_index + 1, new_index + 1
+        blocks.append((old_start, old_end, new_start, new_end))
+    matches.sort()
+    return _get_opcodes(matches, len(old), len(new))
+
+
+def _split_tokens(text: str) -> List[str]:
+    """Split text into Python tokens and the text between them.
+
+    Text that cannot be tokenized, like a hunk starting inside a string, is
+    split into words, whitespace and punctuation instead.
+    """
+    line_offsets = [0]
+    for line in io.StringIO(text):
+        line_offsets.append(line_offsets[-1] + len(line))
+
+    boundaries = {0}
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(text).readline):
+            if token.type == tokenize.ENDMARKER:
+                break
+            for row, col in (token.start, token.end):
+                if row <= len(line_offsets):
+                    boundaries.add(line_offsets[row - 1] + col)
+    except (tokenize.TokenError, SyntaxError):
+        pass
+
+    offsets = sorted(offset for offset in boundaries if offset < len(text))
+    pieces = [text[start:end] for start, end in zip(offsets, offsets[1:])]
+    tail = text[offsets[-1] :] if offsets else ""
+    if tail:
+        pieces.extend(TOKEN_SPLIT_PATTERN.findall(tail))
+    return pieces
+
+
+def _diff_pieces(
+    get_opcodes: Callable[[Sequence[str], Sequence[str]], List[Opcode]],
+    old_pieces: List[str],
+    new_pieces: List[str],
+) -> List[Opcode]:
+    """Return character opcodes from opcodes over pieces of the text."""
+    old_offsets = list(itertools.accumulate(map(len, old_pieces), initial=0))
+    new_offsets = list(itertools.accumulate(map(len, new_pieces), initial=0))
+    return [
+        (
+            opcode,
+            old_offsets[old_start],
+            old_offsets[old_end],
+            new_offsets[new_start],
+            new_offsets[new_end],
+        )
+        for opcode, old_start, old_end, new_start, new_end in get_opcodes(
+            old_pieces, new_pieces
+        )
+    ]
+
+
+def _difflib_diff(old_text: str, new_text: str) -> List[Opcode]:
+    return difflib.SequenceMatcher(a=old_text, b=new_text).get_opcodes()
+
+
+def _levenshtein_diff(old_text: str, new_text: str) -> List[Opcode]:
+    import Levenshtein
+
+    return Levenshtein.opcodes(old_text, new_text)
+
+
+def _token_diff(old_text: str, new_text: str) -> List[Opcode]:
+    return _diff_pieces(
+        _patience_opcodes, _split_tokens(old_text), _split_tokens(new_text)
+    )
+
+
+def _myers_diff(old_text: str, new_text: str) -> List[Opcode]:
+    return _diff_pieces(
+        _myers_opcodes, old_text.splitlines(True), new_text.splitlines(True)
+    )
+
+
+def _patience_diff(old_text: str, new_text: str) -> List[Opcode]:
+    return _diff_pieces(
+        _patience_opcodes, old_text.splitlines(True), new_text.splitlines(True)
+    )
+
+
+# Diff backends by name. Each returns difflib style opcodes over the characters
+# of the texts, at the granularity of the backend: characters, Python tokens or
+# lines.
+DIFF_BACKENDS: Dict[str, DiffBackend] = {
+    "difflib": _difflib_diff,
+    "levenshtein": _levenshtein_diff,
+    "tokenize": _token_diff,
+    "myers": _myers_diff,
+    "patience": _patience_diff,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def has_levenshtein() -> bool:
+    """Returns True if the Levenshtein module can be imported.
+
+    The result is kept, as a failed import searches `sys.path` again each time.
+    """
     try:
-        import Levenshtein
+        import Levenshtein  # noqa: F401
 
-        return Levenshtein.opcodes(old_text, new_text)
+        return True
     except ImportError:
-        return difflib.SequenceMatcher(a=old_text, b=new_text).get_opcodes()
+        return False
+
+
+def select_line_diff(
+    old_lines: Sequence[str], new_lines: Sequence[str]
+) -> Callable[[Sequence[str], Sequence[str]], List[Opcode]]:
+    """Return the line diff to use for a document.
+
+    The Myers diff costs about the number of lines times the number of changed
+    lines, which is estimated from the lines found on only one side.
+    """
+    size = len(old_lines) + len(new_lines)
+    changed = len(set(old_lines).symmetric_difference(new_lines))
+    if size * changed <= MYERS_DIFF_MAX_COST:
+        return _myers_opcodes
+    return _patience_opcodes
+
+
+def select_diff_backend(old_text: str, new_text: str, levenshtein: bool) -> str:
+    """Return the name of the diff backend to use for a block of changed lines."""
+    size = len(old_text) + len(new_text)
+    if levenshtein and size <= LEVENSHTEIN_DIFF_MAX_SIZE:
+        return "levenshtein"
+    if size <= CHARACTER_DIFF_MAX_SIZE:
+        return "difflib"
+    if size <= TOKEN_DIFF_MAX_SIZE:
+        return "tokenize"
+    return "patience"
+
+
+def _to_code_units(
+    line: str, col: int, position_encoding: lsp.PositionEncodingKind
+) -> int:
+    """Return the column in code units of position_encoding for a column in line."""
+    if position_encoding == lsp.PositionEncodingKind.Utf16:
+        return len(line[:col].encode("utf-16-le")) // 2
+    elif position_encoding == lsp.PositionEncodingKind.Utf8:
+        return len(line[:col].encode("utf-8"))
+    return col
+
+
+def _ends_with_line_break(text: str) -> bool:
+    return bool(text) and text[-1] in LINE_BREAKS
+
+
+def _get_line_kind(line: str) -> int:
+    if line.isascii():
+        return ASCII_LINE
+    return ASTRAL_LINE if max(line) > "\uffff" else BMP_LINE
+
+
+def get_line_ending(text: str) -> Optional[str]:
+    """Return the line ending of the first line of text, None if text is empty."""
+    if not text:
+        return None
+    match = LINE_BREAK_PATTERN.search(text)
+    return "\r\n" if match and match.group() == "\r\n" else "\n"
+
+
+class LineIndex:
+    """Lines of a text with the line starts, line ending and kind of each line.
+
+    Columns on lines with only ASCII characters, or in UTF-16 on lines without
+    characters outside the Basic Multilingual Plane, need no conversion.
+    """
+
+    def __init__(self, text: str = "", version: Optional[int] = None):
+        self.version = version
+        self.size = len(text)
+        self.lines: List[str] = text.splitlines(True)
+        self._kinds = [_get_line_kind(line) for line in self.lines]
+        self._line_starts: Optional[List[int]] = None
+
+    @property
+    def line_starts(self) -> List[int]:
+        """Offset of the start of each line, followed by the size of the text."""
+        if self._line_starts is None:
+            self._line_starts = list(
+                itertools.accumulate(map(len, self.lines), initial=0)
+            )
+        return self._line_starts
+
+    @property
+    def line_ending(self) -> Optional[str]:
+        """Line ending of the first line, None if the text is empty."""
+        return get_line_ending(self.lines[0]) if self.lines else None
+
+    def to_code_units(
+        self, line: int, col: int, position_encoding: lsp.PositionEncodingKind
+    ) -> int:
+        """Return the column in code units of position_encoding for a column."""
+        if (
+            position_encoding == lsp.PositionEncodingKind.Utf32
+            or col == 0
+            or line >= len(self.lines)
+        ):
+            return col
+        kind = self._kinds[line]
+        if kind == ASCII_LINE or (
+            kind == BMP_LINE and position_encoding == lsp.PositionEncodingKind.Utf16
+        ):
+            return col
+        return _to_code_units(self.lines[line], col, position_encoding)
+
+    def position_at(
+        self, offset: int, position_encoding: lsp.PositionEncodingKind
+    ) -> lsp.Position:
+        """Return the position of an offset in the text."""
+        line = bisect.bisect_right(self.line_starts, offset) - 1
+        if line == len(self.lines) and self.lines:
+            if not _ends_with_line_break(self.lines[-1]):
+                # End of a last line without line break.
+                line -= 1
+        col = offset - self.line_starts[line]
+        return lsp.Position(
+            line=line, character=self.to_code_units(line, col, position_encoding)
+        )
+
+    def updated(
+        self,
+        start: Tuple[int, int],
+        end: Tuple[int, int],
+        text: str,
+        version: Optional[int] = None,
+    ) -> "LineIndex":
+        """Return the index of the text with the range from start to end replaced.
+
+        Start and end are `(line, column)` in code points, applied the same way
+        as pygls applies incremental changes. Only the changed lines are split
+        again.
+        """
+        (start_line, start_col), (end_line, end_col) = start, end
+        if end_line < start_line:
+            raise ValueError(f"Invalid range: {start} to {end}")
+
+        lines = self.lines
+        if start_line >= len(lines):
+            # pygls appends changes past the last line.
+            start_line, end_line = len(lines), len(lines)
+        first = start_line
+        if first > 0 and (
+            lines[first - 1].endswith("\r")
+            or not _ends_with_line_break(lines[first - 1])
+        ):
+            # The new text may join the previous line.
+            first -= 1
+        last = min(end_line + 1, len(lines))
+        region = "".join(lines[first:start_line])
+        if start_line < len(lines):
+            region += lines[start_line][:start_col]
+        region += text
+        if end_line < len(lines):
+            region += lines[end_line][end_col:]
+        if (
+            region
+            and last < len(lines)
+            and (region.endswith("\r") or not _ends_with_line_break(region))
+        ):
+            # The next line may join the new text.
+            region += lines[last]
+            last += 1
+
+        new_lines = region.splitlines(True)
+        index = copy.copy(self)
+        index.version = version
+        index.size = self.size - sum(map(len, lines[first:last])) + len(region)
+        index.lines = lines[:first] + new_lines + lines[last:]
+        index._kinds = (
+            self._kinds[:first]
+            + [_get_line_kind(line) for line in new_lines]
+            + self._kinds[last:]
+        )
+        index._line_starts = None
+        return index
+
+
+def _get_hunk_changes(
+    old_text: str, new_text: str, levenshtein: bool = False
+) -> List[Opcode]:
+    """Return the changes in a block of changed lines, diffing only those lines."""
+    if not old_text or not new_text:
+        return [("replace", 0, len(old_text), 0, len(new_text))]
+    backend = select_diff_backend(old_text, new_text, levenshtein)
+    return [
+        opcode
+        for opcode in DIFF_BACKENDS[backend](old_text, new_text)
+        if opcode[0] != "equal"
+    ]
+
+
+def compact_changes(
+    changes: Sequence[Opcode], merge_gap: int = 0, max_edits: Optional[int] = None
+) -> List[Opcode]:
+    """Merge changes that are at most merge_gap characters apart.
+
+    If there are still more than max_edits changes, the closest changes are
+    merged until there are at most max_edits. The unchanged text between merged
+    changes is replaced with itself.
+    """
+    gaps = [
+        change[1] - previous[2] for previous, change in zip(changes, changes[1:])
+    ]
+    if max_edits and len(changes) > max_edits:
+        merge_gap = max(merge_gap, sorted(gaps)[len(changes) - max_edits - 1])
+
+    compacted: List[Opcode] = []
+    for change, gap in zip(changes, [None] + gaps):
+        if gap is not None and gap <= merge_gap:
+            _, old_start, _, new_start, _ = compacted[-1]
+            _, _, old_end, _, new_end = change
+            compacted[-1] = ("replace", old_start, old_end, new_start, new_end)
+        else:
+            compacted.append(change)
+    return compacted
 
 
 def get_text_edits(
@@ -26,56 +615,84 @@ def get_text_edits(
     new_text: str,
     position_encoding: lsp.PositionEncodingKind,
     timeout: Optional[int] = None,
+    merge_gap: int = 0,
+    max_edits: Optional[int] = None,
+    old_index: Optional[LineIndex] = None,
 ) -> List[lsp.TextEdit]:
-    """Return a list of text edits to transform old_text into new_text."""
+    """Return a list of text edits to transform old_text into new_text.
 
-    def code_units(c: str) -> int:
-        if position_encoding == lsp.PositionEncodingKind.Utf16:
-            return len(c.encode("utf-16-le")) // 2
-        elif position_encoding == lsp.PositionEncodingKind.Utf8:
-            return len(c.encode("utf-8"))
-        return len(c.encode("utf-32-le")) // 4
+    Changed blocks of lines are found first, then only the text in those blocks
+    is compared, with a diff backend picked by the size of the block. Changes
+    are merged as in `compact_changes`, and positions are only computed for
+    lines that changed. old_index, if given, must be the index of old_text.
+    """
+    if old_index is None or old_index.size != len(old_text):
+        old_index = LineIndex(old_text)
+    old_lines = old_index.lines
+    new_lines = new_text.splitlines(True)
 
-    line_offsets = [0]
-    code_unit_offsets = []
+    def get_edits() -> List[lsp.TextEdit]:
+        levenshtein = has_levenshtein()
+        old_offsets = old_index.line_starts
+        new_offsets = list(itertools.accumulate(map(len, new_lines), initial=0))
 
-    for line in old_text.splitlines(True):
-        col_offset = [0]
-        for c in line:
-            col_offset.append(col_offset[-1] + code_units(c))
-        code_unit_offsets.append(col_offset)
-        line_offsets.append(line_offsets[-1] + len(line))
-    code_unit_offsets.append([0])
+        changes = []
+        line_diff = select_line_diff(old_lines, new_lines)
+        for opcode, old_start, old_end, new_start, new_end in line_diff(
+            old_lines, new_lines
+        ):
+            if opcode == "equal":
+                continue
+            old_offset, new_offset = old_offsets[old_start], new_offsets[new_start]
+            for tag, start, end, new_text_start, new_text_end in _get_hunk_changes(
+                old_text[old_offset : old_offsets[old_end]],
+                new_text[new_offset : new_offsets[new_end]],
+                levenshtein,
+            ):
+                changes.append(
+                    (
+                        tag,
+                        old_offset + start,
+                        old_offset + end,
+                        new_offset + new_text_start,
+                        new_offset + new_text_end,
+                    )
+                )
 
-    def from_offset(offset: int) -> lsp.Position:
-        line = bisect.bisect_right(line_offsets, offset) - 1
-        col = offset - line_offsets[line]
-        character = code_unit_offsets[line][col]
-        return lsp.Position(line=line, character=character)
+        return [
+            lsp.TextEdit(
+                range=lsp.Range(
+                    start=old_index.position_at(start, position_encoding),
+                    end=old_index.position_at(end, position_encoding),
+                ),
+                new_text=new_text[new_text_start:new_text_end],
+            )
+            for _, start, end, new_text_start, new_text_end in compact_changes(
+                changes, merge_gap, max_edits
+            )
+        ]
 
-    sequences = []
+    edits = None
     try:
-        thread = Thread(target=lambda: sequences.extend(_get_diff(old_text, new_text)))
+        result = []
+        thread = Thread(target=lambda: result.append(get_edits()), daemon=True)
         thread.start()
         thread.join(timeout or DIFF_TIMEOUT)
+        if result:
+            edits = result[0]
     except Exception:
         pass
 
-    if sequences:
-        edits = [
-            lsp.TextEdit(
-                range=lsp.Range(start=from_offset(old_start), end=from_offset(old_end)),
-                new_text=new_text[new_start:new_end],
-            )
-            for opcode, old_start, old_end, new_start, new_end in sequences
-            if opcode != "equal"
-        ]
+    if edits is not None:
         return edits
 
     # return single edit with whole document
     return [
         lsp.TextEdit(
-            range=lsp.Range(start=from_offset(0), end=from_offset(len(old_text))),
+            range=lsp.Range(
+                start=lsp.Position(line=0, character=0),
+                end=old_index.position_at(old_index.size, position_encoding),
+            ),
             new_text=new_text,
         )
     ]
@@ -6,16 +6,46 @@
 import atexit
 import io
 import json
+import mmap
 import os
 import pathlib
+import queue
+import selectors
+import struct
 import subprocess
+import sys
+import tempfile
 import threading
+import time
 import uuid
-from concurrent.futures import ThreadPoolExecutor
-from typing import BinaryIO, Dict, Optional, Sequence, Union
+from concurrent.futures import FIRST_COMPLETED, CancelledError, Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import wait
+from typing import (BinaryIO, Callable, Dict, Iterator, List, Optional,
+                    Sequence, Set, Tuple, Union)
 
 CONTENT_LENGTH = "Content-Length: "
+CONTENT_LENGTH_FRAMING = "content-length"
+# Compact frames start with a marker byte that cannot start a header line,
+# followed by the envelope and text lengths. The envelope is the JSON message
+# without its text field, which follows as raw UTF-8.
+COMPACT_FRAMING = "compact"
+COMPACT_MARKER = b"\x00"
+COMPACT_HEADER = struct.Struct("<II")
+COMPACT_TEXT_KEYS = ("source", "result")
+TEXT_KEY = "textKey"
+# Largest buffer kept for reading compact frames, larger frames are read into
+# a buffer of their own so one large message does not hold on to its size.
+COMPACT_BUFFER_MAX_SIZE = 1024 * 1024
 RUNNER_SCRIPT = str(pathlib.Path(__file__).parent / "lsp_runner.py")
+# Text of at least this many characters is passed through a shared file
+# instead of inside the JSON-RPC message.
+SHARED_TEXT_MIN_SIZE = 1024 * 1024
+SHARED_MEMORY_DIR = "/dev/shm"
+# Runners fork a child with the tool already imported for each run.
+USE_FORK_SERVER = sys.platform == "linux"
+# Number of didChange notifications kept for each document to update runners.
+MAX_DOCUMENT_CHANGES = 1000
 
 
 def to_str(text) -> str:
@@ -23,6 +53,48 @@ def to_str(text) -> str:
     return text.decode("utf-8") if isinstance(text, bytes) else text
 
 
+def _get_shared_dir() -> Optional[str]:
+    # On Linux /dev/shm is memory backed, elsewhere use the temp directory.
+    if os.path.isdir(SHARED_MEMORY_DIR) and os.access(SHARED_MEMORY_DIR, os.W_OK):
+        return SHARED_MEMORY_DIR
+    return None
+
+
+def write_shared_text(text: str) -> Dict[str, Union[str, int]]:
+    """Writes text to a shared file and returns the handle to send over JSON-RPC.
+
+    The receiver maps the file instead of reading the text from the message, so
+    large texts are not escaped into JSON and copied through the pipe.
+    """
+    content = text.encode("utf-8")
+    fd, path = tempfile.mkstemp(prefix="autopep8-", dir=_get_shared_dir())
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(content)
+    except:  # pylint: disable=bare-except
+        remove_shared_text({"path": path})
+        raise
+    return {"path": path, "length": len(content)}
+
+
+def read_shared_text(handle: Dict[str, Union[str, int]]) -> str:
+    """Reads the text from a shared file written by `write_shared_text`."""
+    length = handle["length"]
+    if not length:
+        return ""
+    with open(handle["path"], "rb") as file:
+        with mmap.mmap(file.fileno(), length, access=mmap.ACCESS_READ) as data:
+            return str(data, "utf-8")
+
+
+def remove_shared_text(handle: Dict[str, Union[str, int]]) -> None:
+    """Removes a shared file written by `write_shared_text`."""
+    try:
+        os.unlink(handle["path"])
+    except OSError:
+        pass
+
+
 class StreamClosedException(Exception):
     """JSON RPC stream is closed."""
 
@@ -42,17 +114,37 @@ class JsonWriter:
             if not self._writer.closed:
                 self._writer.close()
 
-    def write(self, data):
+    def write(self, data, framing: str = CONTENT_LENGTH_FRAMING):
         """Writes given data to stream in JSON-RPC format."""
         if self._writer.closed:
             raise StreamClosedException()
 
+        if framing == COMPACT_FRAMING:
+            self._write_compact(data)
+            return
+
         with self._lock:
-            content = json.dumps(data)
-            length = len(content.encode("utf-8"))
-            self._writer.write(
-                f"{CONTENT_LENGTH}{length}\r\n\r\n{content}".encode("utf-8")
-            )
+            # Encode the content once and write it after the header, instead of
+            # building the whole message as another copy of the content.
+            content = json.dumps(data).encode("utf-8")
+            self._writer.write(f"{CONTENT_LENGTH}{len(content)}\r\n\r\n".encode("utf-8"))
+            self._writer.write(content)
+            self._writer.flush()
+
+    def _write_compact(self, data):
+        text = b""
+        for key in COMPACT_TEXT_KEYS:
+            if isinstance(data.get(key), str):
+                data = data.copy()
+                text = data.pop(key).encode("utf-8")
+                data[TEXT_KEY] = key
+                break
+        envelope = json.dumps(data).encode("utf-8")
+
+        with self._lock:
+            self._writer.write(COMPACT_MARKER + COMPACT_HEADER.pack(len(envelope), len(text)))
+            self._writer.write(envelope)
+            self._writer.write(text)
             self._writer.flush()
 
 
@@ -61,6 +153,10 @@ class JsonReader:
 
     def __init__(self, reader: io.TextIOWrapper):
         self._reader = reader
+        # Framing of the last message read.
+        self.framing = CONTENT_LENGTH_FRAMING
+        self._header = bytearray(COMPACT_HEADER.size)
+        self._buffer = bytearray()
 
     def close(self):
         """Closes the underlying reader stream."""
@@ -71,11 +167,21 @@ class JsonReader:
         """Reads data from the stream in JSON-RPC format."""
         if self._reader.closed:
             raise StreamClosedException
+        first = self._reader.read(1)
+        if not first:
+            raise EOFError
+        if first == COMPACT_MARKER:
+            self.framing = COMPACT_FRAMING
+            return self._read_compact()
+        self.framing = CONTENT_LENGTH_FRAMING
+
         length = None
+        line = to_str(first + self._readline())
         while not length:
-            line = to_str(self._readline())
             if line.startswith(CONTENT_LENGTH):
                 length = int(line[len(CONTENT_LENGTH) :])
+            else:
+                line = to_str(self._readline())
 
         line = to_str(self._readline()).strip()
         while line:
@@ -84,6 +190,29 @@ class JsonReader:
         content = to_str(self._reader.read(length))
         return json.loads(content)
 
+    def _read_compact(self):
+        self._readinto(memoryview(self._header))
+        envelope_length, text_length = COMPACT_HEADER.unpack(self._header)
+        length = envelope_length + text_length
+        buffer = self._buffer
+        if length > COMPACT_BUFFER_MAX_SIZE:
+            buffer = bytearray(length)
+        elif len(buffer) < length:
+            buffer = self._buffer = bytearray(length)
+        with memoryview(buffer) as view:
+            self._readinto(view[:length])
+            data = json.loads(str(view[:envelope_length], "utf-8"))
+            if TEXT_KEY in data:
+                data[data.pop(TEXT_KEY)] = str(view[envelope_length:length], "utf-8")
+        return data
+
+    def _readinto(self, view: memoryview):
+        while view:
+            count = self._reader.readinto(view)
+            if not count:
+                raise EOFError
+            view = view[count:]
+
     def _readline(self):
         line = self._reader.readline()
         if not line:
@@ -94,9 +223,21 @@ class JsonReader:
 class JsonRpc:
     """Manages sending and receiving data over JSON-RPC."""
 
-    def __init__(self, reader: io.TextIOWrapper, writer: io.TextIOWrapper):
+    def __init__(
+        self,
+        reader: io.TextIOWrapper,
+        writer: io.TextIOWrapper,
+        framing: str = CONTENT_LENGTH_FRAMING,
+    ):
         self._reader = JsonReader(reader)
         self._writer = JsonWriter(writer)
+        self.framing = framing
+        # Version of each document the peer has cached.
+        self.documents: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Union[Future, queue.Queue]] = {}
+        self._response_reader: Optional[threading.Thread] = None
+        self._response_error: Optional[Exception] = None
 
     def close(self):
         """Closes the underlying streams."""
@@ -111,45 +252,264 @@ class JsonRpc:
 
     def send_data(self, data):
         """Send given data in JSON-RPC format."""
-        self._writer.write(data)
+        self._writer.write(data, self.framing)
 
     def receive_data(self):
-        """Receive data in JSON-RPC format."""
-        return self._reader.read()
+        """Receive data in JSON-RPC format.
+
+        Later messages are sent with the framing of the received message, so a
+        peer that starts with compact framing gets compact replies.
+        """
+        data = self._reader.read()
+        self.framing = self._reader.framing
+        return data
+
+    def send_request(self, data) -> Future:
+        """Send given request, the future gets the response with the same id.
+
+        Responses are read on a separate thread, so requests from several
+        threads can wait for their responses at the same time.
+        """
+        future = Future()
+        self._send_pending(data, future)
+        return future
+
+    def send_stream_request(self, data) -> queue.Queue:
+        """Send given request, the queue gets each response with the same id.
 
+        The last response has "done" set. If the stream ends first the
+        exception is put on the queue instead.
+        """
+        responses = queue.Queue()
+        self._send_pending(data, responses)
+        return responses
 
-def create_json_rpc(readable: BinaryIO, writable: BinaryIO) -> JsonRpc:
+    def has_pending(self) -> bool:
+        """Returns whether any request is waiting for responses."""
+        with self._lock:
+            return bool(self._pending)
+
+    def discard_request(self, msg_id: str) -> None:
+        """Stops waiting for responses to a request, later ones are dropped."""
+        with self._lock:
+            self._pending.pop(msg_id, None)
+
+    def _send_pending(self, data, pending: Union[Future, queue.Queue]) -> None:
+        with self._lock:
+            if self._response_error:
+                raise StreamClosedException() from self._response_error
+            self._pending[data["id"]] = pending
+            if self._response_reader is None:
+                self._response_reader = threading.Thread(
+                    target=self._read_responses, daemon=True
+                )
+                self._response_reader.start()
+        try:
+            self.send_data(data)
+        except:  # pylint: disable=bare-except
+            self.discard_request(data["id"])
+            raise
+
+    def _read_responses(self):
+        while True:
+            try:
+                data = self.receive_data()
+            except Exception as ex:  # pylint: disable=broad-except
+                with self._lock:
+                    self._response_error = ex
+                    pending = list(self._pending.values())
+                    self._pending.clear()
+                for waiting in pending:
+                    if isinstance(waiting, Future):
+                        waiting.set_exception(ex)
+                    else:
+                        waiting.put(ex)
+                return
+            with self._lock:
+                waiting = self._pending.get(data.get("id"))
+                if isinstance(waiting, Future) or data.get("done", False):
+                    self._pending.pop(data.get("id"), None)
+            if isinstance(waiting, Future):
+                waiting.set_result(data)
+            elif waiting:
+                waiting.put(data)
+            elif "sharedResult" in data:
+                # Nobody reads the result of a discarded request.
+                remove_shared_text(data["sharedResult"])
+
+
+def create_json_rpc(
+    readable: BinaryIO, writable: BinaryIO, framing: str = CONTENT_LENGTH_FRAMING
+) -> JsonRpc:
     """Creates JSON-RPC wrapper for the readable and writable streams."""
-    return JsonRpc(readable, writable)
+    return JsonRpc(readable, writable, framing)
+
+
+class ProcessMonitor:
+    """Calls back when watched processes exit, all from a single thread.
+
+    Where pidfds are supported the thread waits on one for each process,
+    otherwise it checks the processes every `poll_interval` seconds.
+    """
+
+    def __init__(self, poll_interval: float = 1.0):
+        self._poll_interval = poll_interval
+        self._callbacks: Dict[subprocess.Popen, Callable[[], None]] = {}
+        self._pidfds: Dict[subprocess.Popen, int] = {}
+        self._selector: Optional[selectors.BaseSelector] = None
+        self._wake_fds: Optional[Tuple[int, int]] = None
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def watch(self, proc: subprocess.Popen, callback: Callable[[], None]) -> None:
+        """Calls `callback` once the process exits."""
+        with self._lock:
+            self._callbacks[proc] = callback
+            if self._thread is None:
+                if hasattr(os, "pidfd_open"):
+                    self._selector = selectors.DefaultSelector()
+                    self._wake_fds = os.pipe()
+                    os.set_blocking(self._wake_fds[1], False)
+                    self._selector.register(self._wake_fds[0], selectors.EVENT_READ)
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            if self._selector is not None:
+                try:
+                    pidfd = os.pidfd_open(proc.pid)
+                except OSError:
+                    # Already reaped, or pidfds are not supported by the kernel.
+                    pidfd = None
+                if pidfd is not None:
+                    self._pidfds[proc] = pidfd
+                    self._selector.register(pidfd, selectors.EVENT_READ, proc)
+        self._wake_up()
+
+    def _wake_up(self) -> None:
+        if self._wake_fds is not None:
+            try:
+                os.write(self._wake_fds[1], b"\0")
+            except BlockingIOError:
+                pass  # A wake up is pending already.
+        else:
+            self._wake.set()
+
+    def _wait(self) -> None:
+        with self._lock:
+            # Processes without a pidfd are checked every interval.
+            timeout = (
+                self._poll_interval if len(self._pidfds) < len(self._callbacks) else None
+            )
+        if self._selector is None:
+            self._wake.wait(timeout)
+            self._wake.clear()
+            return
+        for key, _ in self._selector.select(timeout):
+            if key.data is None:
+                os.read(key.fd, 1024)
+
+    def _run(self) -> None:
+        while True:
+            self._wait()
+            with self._lock:
+                exited = [proc for proc in self._callbacks if proc.poll() is not None]
+                callbacks = [self._callbacks.pop(proc) for proc in exited]
+                for proc in exited:
+                    pidfd = self._pidfds.pop(proc, None)
+                    if pidfd is not None:
+                        self._selector.unregister(pidfd)
+                        os.close(pidfd)
+            for callback in callbacks:
+                try:
+                    callback()
+                except:  # pylint: disable=bare-except
+                    pass
+
+
+# Runners are shared by the workspaces that use the same interpreter and
+# environment, the environment includes the import strategy.
+RunnerKey = Tuple[Tuple[str, ...], Tuple[Tuple[str, str], ...]]
+
+
+def get_runner_key(
+    interpreter: Sequence[str], env: Optional[Dict[str, str]] = None
+) -> RunnerKey:
+    """Returns the key of the runner for the interpreter and environment."""
+    return (tuple(interpreter), tuple(sorted((env or {}).items())))
+
+
+# Runners stop after this many seconds without runs, and are replaced after
+# this many runs or once they use this many MiB of memory. 0 turns each off.
+RUNNER_IDLE_TIMEOUT = 300
+RUNNER_MAX_RUNS = 1000
+RUNNER_MAX_MEMORY = 512
+# The memory use of a runner is read once every this many runs.
+RUNNER_MEMORY_CHECK_INTERVAL = 10
+
+
+def _get_memory_use(pid: int) -> Optional[int]:
+    """Returns the resident memory of the process in bytes, where it is known."""
+    try:
+        with open(f"/proc/{pid}/statm", "rb") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
 
 
 class ProcessManager:
-    """Manages sub-processes launched for running tools."""
+    """Manages sub-processes launched for running tools.
+
+    Processes are kept by runner key, and workspaces are counted as users of
+    the runner they last used. A runner no workspace uses any more is stopped,
+    and so is a runner without runs for `idle_timeout` seconds. A runner that
+    did `max_runs` runs, or uses more than `max_memory` MiB, is replaced: the
+    new runner is started next to it, and takes over the runs once it answers.
+    Replaced runners exit once their pending runs are done.
+    """
 
-    def __init__(self):
-        self._args: Dict[str, Sequence[str]] = {}
-        self._processes: Dict[str, subprocess.Popen] = {}
-        self._rpc: Dict[str, JsonRpc] = {}
+    def __init__(
+        self,
+        idle_timeout: float = RUNNER_IDLE_TIMEOUT,
+        max_runs: int = RUNNER_MAX_RUNS,
+        max_memory: int = RUNNER_MAX_MEMORY,
+    ):
+        self._processes: Dict[RunnerKey, subprocess.Popen] = {}
+        self._rpc: Dict[RunnerKey, JsonRpc] = {}
+        self._workspaces: Dict[str, RunnerKey] = {}
+        self._users: Dict[RunnerKey, int] = {}
+        self._runs: Dict[RunnerKey, int] = {}
+        self._last_used: Dict[RunnerKey, float] = {}
+        self._replacements: Dict[
+            RunnerKey, Tuple[subprocess.Popen, JsonRpc, Future]
+        ] = {}
+        self._retiring: Dict[subprocess.Popen, JsonRpc] = {}
+        self._stopping: Set[subprocess.Popen] = set()
+        self._reaper: Optional[threading.Timer] = None
         self._lock = threading.Lock()
-        self._thread_pool = ThreadPoolExecutor(10)
+        self._start_lock = threading.Lock()
+        self.configure(idle_timeout, max_runs, max_memory)
+
+    def configure(self, idle_timeout: float, max_runs: int, max_memory: int) -> None:
+        """Changes when runners are stopped or replaced."""
+        self._idle_timeout = idle_timeout
+        self._max_runs = max_runs
+        self._max_memory = max_memory
 
     def stop_all_processes(self):
         """Send exit command to all processes and shutdown transport."""
-        for i in self._rpc.values():
+        for i in self._all_rpcs():
             try:
                 i.send_data({"id": str(uuid.uuid4()), "method": "exit"})
             except:  # pylint: disable=bare-except
                 pass
-        self._thread_pool.shutdown(wait=False)
 
-    def start_process(
+    def _spawn(
         self,
-        workspace: str,
+        key: RunnerKey,
         args: Sequence[str],
         cwd: str,
         env: Optional[Dict[str, str]] = None,
-    ) -> None:
-        """Starts a process and establishes JSON-RPC communication over stdio."""
+    ) -> Tuple[subprocess.Popen, JsonRpc]:
         new_env = os.environ.copy()
         if env:
             new_env.update(env)
@@ -161,55 +521,339 @@ class ProcessManager:
             stdin=subprocess.PIPE,
             env=new_env,
         )
-        self._processes[workspace] = proc
-        self._rpc[workspace] = create_json_rpc(proc.stdout, proc.stdin)
+        rpc = create_json_rpc(proc.stdout, proc.stdin, COMPACT_FRAMING)
+        return proc, rpc
 
-        def _monitor_process():
-            proc.wait()
-            with self._lock:
+    def _watch(self, key: RunnerKey, proc: subprocess.Popen) -> None:
+        """Cleans up after the process exits, once it is registered under key."""
+        _process_monitor.watch(proc, lambda: self._on_exit(key, proc))
+
+    def _on_exit(self, key: RunnerKey, proc: subprocess.Popen) -> None:
+        with self._lock:
+            if self._processes.get(key) is proc:
+                del self._processes[key]
+                rpc = self._rpc.pop(key)
+            elif self._replacements.get(key, (None,))[0] is proc:
+                rpc = self._replacements.pop(key)[1]
+            else:
+                # The process may already have been replaced by a new one.
+                rpc = self._retiring.pop(proc, None)
+                self._stopping.discard(proc)
+        if rpc:
+            rpc.close()
+
+    def start_process(
+        self,
+        key: RunnerKey,
+        args: Sequence[str],
+        cwd: str,
+        env: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """Starts a process and establishes JSON-RPC communication over stdio."""
+        proc, rpc = self._spawn(key, args, cwd, env)
+        with self._lock:
+            self._processes[key] = proc
+            self._rpc[key] = rpc
+            self._runs[key] = 0
+            self._last_used[key] = time.monotonic()
+        self._watch(key, proc)
+
+    def get_or_start(
+        self,
+        workspace: str,
+        key: RunnerKey,
+        args: Sequence[str],
+        cwd: str,
+        env: Optional[Dict[str, str]] = None,
+    ) -> JsonRpc:
+        """Gets the runner for the key, starting it if needed, for the workspace.
+
+        The runner the workspace used before is stopped if no other workspace
+        uses it.
+        """
+        with self._lock:
+            previous = self._workspaces.get(workspace)
+            if previous != key:
+                self._workspaces[workspace] = key
+                self._users[key] = self._users.get(key, 0) + 1
+                if previous is not None:
+                    self._users[previous] -= 1
+                    if self._users[previous] == 0:
+                        del self._users[previous]
+                    else:
+                        previous = None
+        if previous is not None and previous != key:
+            self._stop_runner(previous)
+
+        with self._start_lock:
+            self._use_replacement(key)
+            try:
+                rpc = self.get_json_rpc(key)
+            except StreamClosedException:
+                self.start_process(key, args, cwd, env)
+                rpc = self.get_json_rpc(key)
+            if self._count_run(key):
+                self._start_replacement(key, args, cwd, env)
+        self._exit_retired()
+        self._start_reaper()
+        return rpc
+
+    def _count_run(self, key: RunnerKey) -> bool:
+        """Counts a run, returns whether the runner should be replaced."""
+        with self._lock:
+            runs = self._runs.get(key, 0) + 1
+            self._runs[key] = runs
+            self._last_used[key] = time.monotonic()
+            if key in self._replacements or key not in self._processes:
+                return False
+            if self._max_runs and runs >= self._max_runs:
+                return True
+            if self._max_memory and runs % RUNNER_MEMORY_CHECK_INTERVAL == 0:
+                memory = _get_memory_use(self._processes[key].pid)
+                return memory is not None and memory > self._max_memory * 1024 * 1024
+            return False
+
+    def _start_replacement(
+        self,
+        key: RunnerKey,
+        args: Sequence[str],
+        cwd: str,
+        env: Optional[Dict[str, str]] = None,
+    ) -> None:
+        proc, rpc = self._spawn(key, args, cwd, env)
+        try:
+            ready = rpc.send_request({"id": str(uuid.uuid4()), "method": "ping"})
+        except:  # pylint: disable=bare-except
+            proc.kill()
+            rpc.close()
+            return
+        with self._lock:
+            self._replacements[key] = (proc, rpc, ready)
+        self._watch(key, proc)
+
+    def _use_replacement(self, key: RunnerKey) -> None:
+        """Swaps in the replacement runner once it is ready."""
+        with self._lock:
+            if key not in self._replacements:
+                return
+            proc, rpc, ready = self._replacements[key]
+            if key in self._processes:
+                if not ready.done():
+                    return
+                if ready.exception() is not None:
+                    # Keep the current runner, it is replaced again later.
+                    del self._replacements[key]
+                    self._retiring[proc] = rpc
+                    return
+                self._retiring[self._processes[key]] = self._rpc[key]
+            del self._replacements[key]
+            self._processes[key] = proc
+            self._rpc[key] = rpc
+            self._runs[key] = 0
+
+    def _exit_retired(self) -> None:
+        """Asks the replaced runners that have no pending runs to exit.
+
+        Stopped runners are killed instead, they may still be busy with runs
+        nobody waits for.
+        """
+        with self._lock:
+            idle = [
+                (proc, rpc, proc in self._stopping)
+                for proc, rpc in self._retiring.items()
+                if not rpc.has_pending()
+            ]
+        for proc, rpc, stopping in idle:
+            try:
+                if stopping:
+                    proc.kill()
+                else:
+                    rpc.send_data({"id": str(uuid.uuid4()), "method": "exit"})
+            except:  # pylint: disable=bare-except
+                pass
+
+    def _start_reaper(self) -> None:
+        with self._lock:
+            if self._reaper is not None or not self._idle_timeout:
+                return
+            if not (self._processes or self._retiring):
+                return
+            self._reaper = threading.Timer(self._idle_timeout / 2, self._reap)
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def _reap(self) -> None:
+        """Retires the runners that were not used for the idle timeout."""
+        now = time.monotonic()
+        with self._lock:
+            self._reaper = None
+            for key in list(self._processes):
+                idle = now - self._last_used.get(key, now)
+                if idle < self._idle_timeout or self._rpc[key].has_pending():
+                    continue
+                self._retiring[self._processes.pop(key)] = self._rpc.pop(key)
+                if key in self._replacements:
+                    proc, rpc, _ = self._replacements.pop(key)
+                    self._retiring[proc] = rpc
+        self._exit_retired()
+        self._start_reaper()
+
+    def stop_process(self, workspace: str) -> None:
+        """Kills the runner of the given workspace, a new one is started on next use.
+
+        A runner other workspaces share is retired instead, and killed once
+        their pending runs are done.
+        """
+        with self._lock:
+            key = self._workspaces.get(workspace)
+            shared = self._users.get(key, 0) > 1 and key in self._processes
+            if shared:
+                proc = self._processes.pop(key)
+                self._retiring[proc] = self._rpc.pop(key)
+                self._stopping.add(proc)
+        if shared:
+            self._exit_retired()
+            self._start_reaper()
+        elif key is not None:
+            self._stop_runner(key)
+
+    def _stop_runner(self, key: RunnerKey) -> None:
+        with self._lock:
+            runners = [(self._processes.pop(key, None), self._rpc.pop(key, None))]
+            runners.append(self._replacements.pop(key, (None, None, None))[:2])
+        for proc, rpc in runners:
+            # Kill the process first, closing the streams waits for a pending read.
+            if proc:
                 try:
-                    del self._processes[workspace]
-                    rpc = self._rpc.pop(workspace)
-                    rpc.close()
+                    proc.kill()
                 except:  # pylint: disable=bare-except
                     pass
+            if rpc:
+                rpc.close()
 
-        self._thread_pool.submit(_monitor_process)
+    def _all_rpcs(self) -> List[JsonRpc]:
+        with self._lock:
+            return [
+                *self._rpc.values(),
+                *(rpc for _, rpc, _ in self._replacements.values()),
+                *self._retiring.values(),
+            ]
 
-    def get_json_rpc(self, workspace: str) -> JsonRpc:
-        """Gets the JSON-RPC wrapper for the a given id."""
+    def has_document(self, uri: str) -> bool:
+        """Returns whether any process has the document cached."""
+        return any(uri in rpc.documents for rpc in self._all_rpcs())
+
+    def close_document(self, uri: str) -> None:
+        """Tells the processes that have the document cached to drop it."""
+        for rpc in self._all_rpcs():
+            if rpc.documents.pop(uri, None) is not None:
+                try:
+                    rpc.send_data(
+                        {"id": str(uuid.uuid4()), "method": "closeDocument", "uri": uri}
+                    )
+                except:  # pylint: disable=bare-except
+                    pass
+
+    def get_json_rpc(self, key: RunnerKey) -> JsonRpc:
+        """Gets the JSON-RPC wrapper for the a given runner key."""
         with self._lock:
-            if workspace in self._rpc:
-                return self._rpc[workspace]
+            if key in self._rpc:
+                return self._rpc[key]
         raise StreamClosedException()
 
 
+_process_monitor = ProcessMonitor()
 _process_manager = ProcessManager()
 atexit.register(_process_manager.stop_all_processes)
 
 
-def _get_json_rpc(workspace: str) -> Union[JsonRpc, None]:
-    try:
-        return _process_manager.get_json_rpc(workspace)
-    except StreamClosedException:
-        return None
-    except KeyError:
-        return None
-
-
 def get_or_start_json_rpc(
     workspace: str,
     interpreter: Sequence[str],
     cwd: str,
     env: Optional[Dict[str, str]] = None,
 ) -> Union[JsonRpc, None]:
-    """Gets an existing JSON-RPC connection or starts one and return it."""
-    res = _get_json_rpc(workspace)
-    if not res:
-        args = [*interpreter, RUNNER_SCRIPT]
-        _process_manager.start_process(workspace, args, cwd, env)
-        res = _get_json_rpc(workspace)
-    return res
+    """Gets an existing JSON-RPC connection or starts one and return it.
+
+    Workspaces with the same interpreter and environment share the runner,
+    `cwd` is only where the runner starts, each run is given its own.
+    """
+    args = [*interpreter, RUNNER_SCRIPT]
+    try:
+        return _process_manager.get_or_start(
+            workspace, get_runner_key(interpreter, env), args, cwd, env
+        )
+    except StreamClosedException:
+        return None
+
+
+# Content changes of each open document as (version before, version after,
+# changes, size of their text). A change is [start line, start column, end
+# line, end column, text] with columns in characters, or [text] to replace the
+# whole document.
+DocumentChanges = List[Tuple[Optional[int], int, List[list], int]]
+DOCUMENT_CHANGES: Dict[str, DocumentChanges] = {}
+DOCUMENT_CHANGES_LOCK = threading.Lock()
+
+
+def record_document_changes(
+    uri: str,
+    from_version: Optional[int],
+    to_version: int,
+    changes: List[list],
+    size: int,
+) -> None:
+    """Records the changes that update a document from one version to the next.
+
+    `size` is the length of the document after the changes. Changes are only
+    sent while their text is smaller than the document, so the oldest ones
+    are dropped once the text of all of them reaches that size.
+    """
+    text_size = sum(len(change[-1]) for change in changes)
+    with DOCUMENT_CHANGES_LOCK:
+        log = DOCUMENT_CHANGES.setdefault(uri, [])
+        if log and log[-1][1] != from_version:
+            log.clear()
+        log.append((from_version, to_version, changes, text_size))
+        total = sum(entry[3] for entry in log)
+        while log and (total >= size or len(log) > MAX_DOCUMENT_CHANGES):
+            total -= log.pop(0)[3]
+
+
+def forget_document_changes(uri: str) -> None:
+    """Drops the recorded changes, runners get the whole document next time."""
+    with DOCUMENT_CHANGES_LOCK:
+        DOCUMENT_CHANGES.pop(uri, None)
+
+
+def get_document_changes(
+    uri: str, from_version: int, to_version: int
+) -> Optional[List[list]]:
+    """Returns the changes between two versions of a document, if all are recorded."""
+    if from_version == to_version:
+        return []
+    with DOCUMENT_CHANGES_LOCK:
+        log = list(DOCUMENT_CHANGES.get(uri, ()))
+    start = next((i for i, entry in enumerate(log) if entry[0] == from_version), None)
+    if start is None:
+        return None
+    changes = []
+    for _, version, entry_changes, _ in log[start:]:
+        changes.extend(entry_changes)
+        if version == to_version:
+            return changes
+    return None
+
+
+def is_document_cached(uri: str) -> bool:
+    """Returns whether a runner has a version of the document cached."""
+    return _process_manager.has_document(uri)
+
+
+def close_document(uri: str) -> None:
+    """Drops the changes and runner caches of a closed document."""
+    forget_document_changes(uri)
+    _process_manager.close_document(uri)
 
 
 # pylint: disable=too-few-public-methods
@@ -222,6 +866,26 @@ class RpcRunResult:
         self.exception = exception
 
 
+# pylint: disable=too-few-public-methods
+class RpcRunJob:
+    """Object to hold a job for running tool over RPC with others."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        argv: Sequence[str],
+        cwd: str,
+        source: Optional[str] = None,
+        uri: Optional[str] = None,
+        version: Optional[int] = None,
+    ):
+        self.argv = argv
+        self.cwd = cwd
+        self.source = source
+        self.uri = uri
+        self.version = version
+
+
 # pylint: disable=too-many-arguments
 def run_over_json_rpc(
     workspace: str,
@@ -232,8 +896,20 @@ def run_over_json_rpc(
     cwd: str,
     source: Optional[str] = None,
     env: Optional[Dict[str, str]] = None,
+    timeout: Optional[float] = None,
+    uri: Optional[str] = None,
+    version: Optional[int] = None,
+    cancel: Optional[Future] = None,
 ) -> RpcRunResult:
-    """Uses JSON-RPC to execute a command."""
+    """Uses JSON-RPC to execute a command.
+
+    If `uri` and `version` are given the runner keeps the source, and later
+    runs on the same document only send the changes recorded since.
+
+    If no result is received within `timeout` seconds the run is stopped and
+    `TimeoutError` is raised. If `cancel` is done first the run is stopped and
+    `CancelledError` is raised.
+    """
     rpc: Union[JsonRpc, None] = get_or_start_json_rpc(workspace, interpreter, cwd, env)
     if not rpc:
         raise Exception("Failed to run over JSON-RPC.")
@@ -247,27 +923,220 @@ def run_over_json_rpc(
         "useStdin": use_stdin,
         "cwd": cwd,
     }
-    if source:
-        msg["source"] = source
+    base_version = None
+    if uri is not None and version is not None and source is not None:
+        msg.update({"uri": uri, "version": version, "size": len(source)})
+        base_version = rpc.documents.get(uri)
 
-    rpc.send_data(msg)
-
-    data = rpc.receive_data()
+    data = _send_run(workspace, rpc, msg, source, base_version, timeout, cancel)
+    if data.get("staleDocument", False):
+        # The runner does not have the base version, send the whole source.
+        data = _send_run(workspace, rpc, msg, source, None, timeout, cancel)
 
     if data["id"] != msg_id:
         return RpcRunResult(
             "", f"Invalid result for request: {json.dumps(msg, indent=4)}"
         )
+    return _to_run_result(data)
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def run_many_over_json_rpc(
+    workspace: str,
+    interpreter: Sequence[str],
+    module: str,
+    jobs: Sequence[RpcRunJob],
+    use_stdin: bool,
+    cwd: str,
+    env: Optional[Dict[str, str]] = None,
+    timeout: Optional[float] = None,
+) -> Iterator[Tuple[int, RpcRunResult]]:
+    """Uses JSON-RPC to execute a command for each job in one request.
+
+    Yields the index of each job with its result as the results arrive, in
+    any order. Sources of jobs with `uri` and `version` are kept by the runner
+    as with `run_over_json_rpc`.
+
+    If no result is received within `timeout` seconds of the previous one the
+    runs are stopped and `TimeoutError` is raised.
+    """
+    rpc: Union[JsonRpc, None] = get_or_start_json_rpc(workspace, interpreter, cwd, env)
+    if not rpc:
+        raise Exception("Failed to run over JSON-RPC.")
+
+    pending = list(range(len(jobs)))
+    use_changes = True
+    while pending:
+        msg_id = str(uuid.uuid4())
+        msg = {
+            "id": msg_id,
+            "method": "runMany",
+            "module": module,
+            "useStdin": use_stdin,
+            "jobs": [],
+        }
+        shared_sources = []
+        stale = []
+        try:
+            for index in pending:
+                job = jobs[index]
+                job_msg = {"argv": job.argv, "cwd": job.cwd}
+                base_version = None
+                if job.uri is not None and job.version is not None and job.source is not None:
+                    job_msg.update(
+                        {"uri": job.uri, "version": job.version, "size": len(job.source)}
+                    )
+                    if use_changes:
+                        base_version = rpc.documents.get(job.uri)
+                shared_source = _add_source(job_msg, job.source, base_version)
+                if shared_source:
+                    shared_sources.append(shared_source)
+                msg["jobs"].append(job_msg)
+
+            responses = rpc.send_stream_request(msg)
+            for job_msg in msg["jobs"]:
+                if "uri" in job_msg:
+                    rpc.documents[job_msg["uri"]] = job_msg["version"]
+
+            while True:
+                data = _wait_for_response(workspace, responses, timeout, rpc, msg_id)
+                if data.get("done", False):
+                    break
+                index = pending[data["job"]]
+                if data.get("staleDocument", False):
+                    stale.append(index)
+                else:
+                    yield index, _to_run_result(data)
+        finally:
+            rpc.discard_request(msg_id)
+            for shared_source in shared_sources:
+                remove_shared_text(shared_source)
+
+        # The runner does not have the base version of these, send the whole sources.
+        pending = stale
+        use_changes = False
+
+
+def _to_run_result(data) -> RpcRunResult:
+    if "sharedResult" in data:
+        try:
+            data["result"] = read_shared_text(data["sharedResult"])
+        finally:
+            remove_shared_text(data["sharedResult"])
+
+    result = data["result"] if "result" in data else ""
+    error = data["error"] if "error" in data else ""
+    if data.get("exception", False):
+        return RpcRunResult(result, "", error)
+    return RpcRunResult(result, error)
+
+
+def _add_source(msg: Dict, source: Optional[str], base_version: Optional[int]):
+    """Adds the source, or its changes since base_version, to the message.
+
+    Returns the handle of the shared file if the source is passed in one.
+    """
+    changes = None
+    if base_version is not None:
+        changes = get_document_changes(msg["uri"], base_version, msg["version"])
+
+    if changes is not None and sum(len(change[-1]) for change in changes) < len(source):
+        msg["baseVersion"] = base_version
+        msg["changes"] = changes
+    elif source and len(source) >= SHARED_TEXT_MIN_SIZE:
+        msg["sharedSource"] = write_shared_text(source)
+        return msg["sharedSource"]
+    elif source:
+        msg["source"] = source
+    return None
+
+
+# pylint: disable=too-many-arguments
+def _send_run(
+    workspace: str,
+    rpc: JsonRpc,
+    msg: Dict,
+    source: Optional[str],
+    base_version: Optional[int],
+    timeout: Optional[float],
+    cancel: Optional[Future] = None,
+):
+    """Sends the run request with the source, or its changes since base_version."""
+    msg = dict(msg)
+    shared_source = _add_source(msg, source, base_version)
+    try:
+        future = rpc.send_request(msg)
+        if "uri" in msg:
+            # The runner keeps documents in the order of the requests.
+            rpc.documents[msg["uri"]] = msg["version"]
+        return _wait_for_response(
+            workspace, future, timeout, rpc, msg["id"], cancel
+        )
+    finally:
+        if shared_source:
+            remove_shared_text(shared_source)
+
+
+def _wait_for_response(
+    workspace: str,
+    response: Union[Future, queue.Queue],
+    timeout: Optional[float] = None,
+    rpc: Optional[JsonRpc] = None,
+    msg_id: Optional[str] = None,
+    cancel: Optional[Future] = None,
+):
+    """Waits for the response, stopping the run if it takes too long.
+
+    Runs of a fork server are killed on their own, otherwise the runner
+    process is stopped as by `ProcessManager.stop_process`. If `cancel` is
+    done first the run is stopped the same way, except that other runners
+    finish the run and its response is dropped.
+    """
+    try:
+        if isinstance(response, Future):
+            if cancel is not None:
+                wait((response, cancel), timeout, FIRST_COMPLETED)
+                if cancel.done() and not response.done():
+                    _stop_run(workspace, rpc, msg_id, cancelled=True)
+                    raise CancelledError()
+                # The wait above already took up the timeout.
+                return response.result(0)
+            return response.result(timeout)
+        data = response.get(timeout=timeout)
+    except (FutureTimeoutError, queue.Empty) as ex:
+        _stop_run(workspace, rpc, msg_id)
+        raise TimeoutError(f"Timed out after {timeout}s waiting for runner.") from ex
+    if isinstance(data, Exception):
+        raise data
+    return data
+
+
+def _stop_run(
+    workspace: str,
+    rpc: Optional[JsonRpc],
+    msg_id: Optional[str],
+    cancelled: bool = False,
+) -> None:
+    if rpc and msg_id:
+        rpc.discard_request(msg_id)
+    if USE_FORK_SERVER and rpc and msg_id:
+        try:
+            rpc.send_data(
+                {"id": str(uuid.uuid4()), "method": "cancel", "request": msg_id}
+            )
+        except:  # pylint: disable=bare-except
+            _process_manager.stop_process(workspace)
+    elif not cancelled:
+        # The run would keep a worker of the runner busy.
+        _process_manager.stop_process(workspace)
 
-    if "error" in data:
-        result = data["result"] if "result" in data else ""
-        error = data["error"]
 
-        if data.get("exception", False):
-            return RpcRunResult(result, "", error)
-        return RpcRunResult(result, error)
+def configure_runners(idle_timeout: float, max_runs: int, max_memory: int) -> None:
+    """Sets when runners are stopped after being idle, or replaced.
 
-    return RpcRunResult(result, "")
+    `idle_timeout` is in seconds and `max_memory` in MiB, 0 turns each off.
+    """
+    _process_manager.configure(idle_timeout, max_runs, max_memory)
 
 
 def shutdown_json_rpc():
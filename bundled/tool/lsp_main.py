@@ -0,0 +1,14 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""Starts the language server implemented in `lsp_server`.
+
+Worker processes the server spawns run the main script again, as
+`__mp_main__`, before they import what they run. Keeping the main script this
+small means they do not import pygls or set up a server of their own.
+"""
+
+if __name__ == "__main__":
+    # pylint: disable=import-error
+    import lsp_server
+
+    lsp_server.LSP_SERVER.start_io()
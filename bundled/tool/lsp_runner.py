@@ -4,10 +4,20 @@
 Runner to use when running under a different interpreter.
 """
 
+import functools
+import importlib
 import os
 import pathlib
+import pickle
+import selectors
+import signal
+import struct
 import sys
+import threading
 import traceback
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
 
 # **********************************************************
@@ -36,39 +46,459 @@ update_sys_path(
 import lsp_jsonrpc as jsonrpc
 import lsp_utils as utils
 
-RPC = jsonrpc.create_json_rpc(sys.stdin.buffer, sys.stdout.buffer)
+# Number of requests run at the same time, each in a worker process, set by
+# the server or derived from the number of processors.
+MAX_WORKERS = utils.get_worker_count(int(os.getenv("LS_MAX_WORKERS", "0")))
 
-EXIT_NOW = False
-while not EXIT_NOW:
-    msg = RPC.receive_data()
+# Latest version of each document the server sent, by uri, with its source,
+# or only its line index once changes were applied to it. lsp_edit_utils,
+# which imports lsprotocol, is only imported for the first changes so that the
+# runner starts fast.
+DOCUMENTS: Dict[str, Tuple[int, Any]] = {}
 
-    method = msg["method"]
-    if method == "exit":
-        EXIT_NOW = True
-        continue
+# Modules the fork server imports for its children, with the ones autopep8
+# imports on each run. Only modules that have no side effects on import,
+# others are imported by each run.
+PRELOAD_MODULES = ("autopep8", "shutil", "tomllib", "tomli")
 
-    if method == "run":
-        is_exception = False  # pylint: disable=invalid-name
-        # This is needed to preserve sys.path, pylint modifies
-        # sys.path and that might not work for this scenario
-        # next time around.
-        with utils.substitute_attr(sys, "path", [""] + sys.path[:]):
+
+def read_source(msg: Dict) -> Tuple[bool, Optional[str]]:
+    """Returns if the source of a request is known, and the source.
+
+    The source is not known either if the cached document is stale or if its
+    shared file is gone, which happens when the request was abandoned.
+    """
+    if "sharedSource" in msg:
+        try:
+            source = jsonrpc.read_shared_text(msg["sharedSource"])
+        except OSError:
+            return False, None
+    else:
+        source = msg["source"] if "source" in msg else None
+    if "uri" in msg:
+        source = get_document_source(msg, source)
+        return source is not None, source
+    return True, source
+
+
+def get_document_source(msg: Dict, source: Optional[str]) -> Optional[str]:
+    """Returns the document source and keeps it for the next request.
+
+    The source is either given or built by applying the changes in the
+    request to the cached document. Returns None if the cached document is
+    not the version the changes apply to.
+    """
+    uri = msg["uri"]
+    if "changes" in msg:
+        version, document = DOCUMENTS.pop(uri, (None, None))
+        if version != msg["baseVersion"]:
+            return None
+
+        # pylint: disable=import-outside-toplevel
+        import lsp_edit_utils as edit_utils
+
+        if isinstance(document, edit_utils.LineIndex):
+            index = document
+        else:
+            index = edit_utils.LineIndex(document)
+        try:
+            for change in msg["changes"]:
+                if len(change) == 1:
+                    index = edit_utils.LineIndex(change[0])
+                else:
+                    index = index.updated(
+                        (change[0], change[1]), (change[2], change[3]), change[4]
+                    )
+        except ValueError:
+            return None
+        source = "".join(index.lines)
+        if len(source) != msg["size"]:
+            return None
+        document = index
+    else:
+        source = document = source or ""
+
+    DOCUMENTS[uri] = (msg["version"], document)
+    return source
+
+
+def init_worker(runner_pid: int) -> None:
+    """Detaches a worker process from the JSON-RPC pipes.
+
+    Output of the tool is captured in memory, and a worker left running
+    should not keep the pipes open when the runner is stopped.
+    """
+    utils.detach_stdio()
+    utils.exit_with_parent(runner_pid)
+
+
+def run(
+    module: str,
+    argv: Sequence[str],
+    use_stdin: bool,
+    cwd: str,
+    source: Optional[str],
+) -> Tuple[utils.RunResult, bool]:
+    """Runs the tool in a worker process, returns the result and if it raised."""
+    is_exception = False
+    try:
+        result = utils.run_module(
+            module=module,
+            argv=argv,
+            use_stdin=use_stdin,
+            cwd=cwd,
+            source=source,
+        )
+    except Exception:  # pylint: disable=broad-except
+        result = utils.RunResult("", traceback.format_exc(chain=True))
+        is_exception = True
+    return result, is_exception
+
+
+def send_result(
+    rpc: jsonrpc.JsonRpc, msg_id: str, future: Future, job: Optional[int] = None
+) -> None:
+    """Sends the response to a request, or a job of it, once its run is done."""
+    try:
+        result, is_exception = future.result()
+    except Exception:  # pylint: disable=broad-except
+        # The worker process died.
+        result = utils.RunResult("", traceback.format_exc(chain=True))
+        is_exception = True
+
+    response = {"id": msg_id, "error": result.stderr}
+    if job is not None:
+        response["job"] = job
+    if is_exception:
+        response["exception"] = is_exception
+    elif len(result.stdout) >= jsonrpc.SHARED_TEXT_MIN_SIZE:
+        response["sharedResult"] = jsonrpc.write_shared_text(result.stdout)
+    elif result.stdout:
+        response["result"] = result.stdout
+
+    rpc.send_data(response)
+
+
+class Batch:
+    """Sends the results of the jobs of a runMany request as they are done.
+
+    A last response with "done" set follows the results of all jobs. Until
+    then the batch is in BATCHES, with the keys of its jobs for `cancel`.
+    """
+
+    def __init__(self, rpc: jsonrpc.JsonRpc, msg_id: str, size: int):
+        self._rpc = rpc
+        self._msg_id = msg_id
+        self._remaining = size
+        self._lock = threading.Lock()
+        self.keys: List[str] = []
+        if size == 0:
+            self._send_done()
+        else:
+            BATCHES[msg_id] = self
+
+    def job_done(self, job: int, future: Future) -> None:
+        """Sends the result of a job."""
+        send_result(self._rpc, self._msg_id, future, job)
+        with self._lock:
+            self._remaining -= 1
+            done = self._remaining == 0
+        if done:
+            self._send_done()
+
+    def _send_done(self) -> None:
+        BATCHES.pop(self._msg_id, None)
+        self._rpc.send_data({"id": self._msg_id, "done": True})
+
+
+# Batches with jobs not done yet, by the id of their runMany request.
+BATCHES: Dict[str, Batch] = {}
+
+
+# Frames between the fork server and its zygote: the length of a pickled
+# message, then the message.
+FRAME_HEADER = struct.Struct("<I")
+
+
+def _write_frame(fd: int, message: Any) -> None:
+    data = pickle.dumps(message)
+    with memoryview(FRAME_HEADER.pack(len(data)) + data) as view:
+        while view:
+            view = view[os.write(fd, view) :]
+
+
+def _read_frames(buffer: bytearray) -> List[Any]:
+    """Removes the complete frames from the buffer, returns their messages."""
+    messages = []
+    while len(buffer) >= FRAME_HEADER.size:
+        (length,) = FRAME_HEADER.unpack_from(buffer)
+        end = FRAME_HEADER.size + length
+        if len(buffer) < end:
+            break
+        messages.append(pickle.loads(buffer[FRAME_HEADER.size : end]))
+        del buffer[:end]
+    return messages
+
+
+class ForkServer:
+    """Runs each request in a child forked from a zygote process, on Linux.
+
+    The zygote is forked when the fork server is created, before the runner
+    starts any thread, and stays single threaded: it imports the tool once,
+    then only forks children and hands their results back over a pipe. Each
+    child starts from the state of the zygote and exits after its run. Runs
+    are isolated from each other without reloading the tool, can change the
+    working directory freely and run in parallel.
+    """
+
+    def __init__(self, max_workers: int, preload: Sequence[str] = ()):
+        self._futures: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        request_fds = os.pipe()
+        result_fds = os.pipe()
+        self._zygote = os.fork()
+        if self._zygote == 0:
+            os.close(request_fds[1])
+            os.close(result_fds[0])
+            _run_zygote(request_fds[0], result_fds[1], max_workers, preload)
+        os.close(request_fds[0])
+        os.close(result_fds[1])
+        self._requests: Optional[int] = request_fds[1]
+        self._thread = threading.Thread(
+            target=self._read_results, args=(result_fds[0],), daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, key: str, fn: Callable, *args) -> Future:
+        """Runs fn(*args) in a child process, `key` identifies it to `cancel`."""
+        future: Future = Future()
+        with self._lock:
+            if self._requests is None:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            self._futures[key] = future
+            _write_frame(self._requests, ("run", key, fn, args))
+        return future
+
+    def cancel(self, key: str) -> None:
+        """Kills the child running the call for the given key.
+
+        A call that did not start yet is dropped instead.
+        """
+        with self._lock:
+            if self._requests is not None and key in self._futures:
+                _write_frame(self._requests, ("cancel", key))
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stops the zygote, running children are killed."""
+        with self._lock:
+            requests, self._requests = self._requests, None
+        if requests is not None:
+            os.close(requests)
+        if wait:
+            self._thread.join()
+
+    def _read_results(self, fd: int) -> None:
+        buffer = bytearray()
+        while True:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            buffer += data
+            for kind, key, *result in _read_frames(buffer):
+                with self._lock:
+                    future = self._futures.pop(key, None)
+                if future is None:
+                    continue
+                if kind == "cancelled":
+                    future.cancel()
+                    continue
+                data, status = result
+                if not data:
+                    future.set_exception(
+                        ChildProcessError(f"Runner child exited with status {status}.")
+                    )
+                    continue
+                try:
+                    future.set_result(pickle.loads(data))
+                except Exception as ex:  # pylint: disable=broad-except
+                    future.set_exception(ex)
+
+        os.close(fd)
+        os.waitpid(self._zygote, 0)
+        with self._lock:
+            futures = list(self._futures.values())
+            self._futures.clear()
+        for future in futures:
+            future.set_exception(ChildProcessError("Fork server zygote exited."))
+
+
+def _run_zygote(
+    request_fd: int, result_fd: int, max_workers: int, preload: Sequence[str]
+) -> None:
+    """Forks a child for each run request, until the runner closes the pipe."""
+    try:
+        utils.detach_stdio()
+        for module in preload:
             try:
-                result = utils.run_module(
-                    module=msg["module"],
-                    argv=msg["argv"],
-                    use_stdin=msg["useStdin"],
-                    cwd=msg["cwd"],
-                    source=msg["source"] if "source" in msg else None,
-                )
+                importlib.import_module(module)
             except Exception:  # pylint: disable=broad-except
-                result = utils.RunResult("", traceback.format_exc(chain=True))
-                is_exception = True  # pylint: disable=invalid-name
+                # The child reports the error when it runs the module.
+                pass
+        if "autopep8" in preload:
+            try:
+                utils._prepare_tool("autopep8")  # pylint: disable=protected-access
+            except Exception:  # pylint: disable=broad-except
+                pass
+
+        queue: Dict[str, Tuple[Callable, tuple]] = {}
+        children: Dict[str, int] = {}
+        buffer = bytearray()
+        selector = selectors.DefaultSelector()
+        selector.register(request_fd, selectors.EVENT_READ)
+        while True:
+            while queue and len(children) < max_workers:
+                key = next(iter(queue))
+                fn, args = queue.pop(key)
+                read_fd, write_fd = os.pipe()
+                pid = os.fork()
+                if pid == 0:
+                    os.close(request_fd)
+                    os.close(result_fd)
+                    _run_in_child(read_fd, write_fd, fn, args)
+                os.close(write_fd)
+                children[key] = pid
+                selector.register(read_fd, selectors.EVENT_READ, (key, pid, []))
+
+            for selected, _ in selector.select():
+                if selected.fd == request_fd:
+                    data = os.read(request_fd, 65536)
+                    if not data:
+                        for pid in children.values():
+                            os.kill(pid, signal.SIGKILL)
+                        return
+                    buffer += data
+                    for kind, key, *request in _read_frames(buffer):
+                        if kind == "run":
+                            queue[key] = (request[0], request[1])
+                        elif key in queue:
+                            del queue[key]
+                            _write_frame(result_fd, ("cancelled", key))
+                        elif key in children:
+                            os.kill(children[key], signal.SIGKILL)
+                    continue
+
+                key, pid, chunks = selected.data
+                chunk = os.read(selected.fd, 65536)
+                if chunk:
+                    chunks.append(chunk)
+                    continue
+                selector.unregister(selected.fd)
+                os.close(selected.fd)
+                _, status = os.waitpid(pid, 0)
+                del children[key]
+                _write_frame(result_fd, ("done", key, b"".join(chunks), status))
+    finally:
+        os._exit(0)  # pylint: disable=protected-access
+
+
+def _run_in_child(read_fd: int, write_fd: int, fn: Callable, args) -> None:
+    try:
+        os.close(read_fd)
+        data = pickle.dumps(fn(*args))
+        with os.fdopen(write_fd, "wb") as pipe:
+            pipe.write(data)
+    finally:
+        # Skip clean up of the state shared with the zygote.
+        os._exit(0)  # pylint: disable=protected-access
+
+
+def _create_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        MAX_WORKERS, initializer=init_worker, initargs=(os.getpid(),)
+    )
+
+
+def main() -> None:
+    """Reads requests and runs them in worker processes.
+
+    Responses are sent as the runs complete, so they can be in a different
+    order than the requests.
+    """
+    rpc = jsonrpc.create_json_rpc(sys.stdin.buffer, sys.stdout.buffer)
+    if jsonrpc.USE_FORK_SERVER:
+        pool = ForkServer(MAX_WORKERS, PRELOAD_MODULES)
+    else:
+        pool = _create_pool()
+
+    def _submit(key: str, *args) -> Future:
+        nonlocal pool
+        if isinstance(pool, ForkServer):
+            return pool.submit(key, run, *args)
+        try:
+            return pool.submit(run, *args)
+        except BrokenProcessPool:
+            pool = _create_pool()
+            return pool.submit(run, *args)
+
+    while True:
+        msg = rpc.receive_data()
+
+        method = msg["method"]
+        if method == "exit":
+            break
+
+        if method == "ping":
+            # Answered once the runner is started, before it is used.
+            rpc.send_data({"id": msg["id"]})
+            continue
+
+        if method == "closeDocument":
+            DOCUMENTS.pop(msg["uri"], None)
+            continue
+
+        if method == "cancel":
+            if isinstance(pool, ForkServer):
+                batch = BATCHES.get(msg["request"])
+                for key in batch.keys if batch else [msg["request"]]:
+                    pool.cancel(key)
+            continue
+
+        if method == "run":
+            known, source = read_source(msg)
+            if not known:
+                rpc.send_data({"id": msg["id"], "staleDocument": True})
+                continue
+
+            future = _submit(
+                msg["id"], msg["module"], msg["argv"], msg["useStdin"], msg["cwd"], source
+            )
+            future.add_done_callback(functools.partial(send_result, rpc, msg["id"]))
+
+        if method == "runMany":
+            # Jobs share the message, each job runs like a run request.
+            jobs = []
+            for index, job in enumerate(msg["jobs"]):
+                known, source = read_source(job)
+                if known:
+                    jobs.append((index, job, source))
+                else:
+                    rpc.send_data({"id": msg["id"], "job": index, "staleDocument": True})
+
+            batch = Batch(rpc, msg["id"], len(jobs))
+            batch.keys.extend(f"{msg['id']}:{index}" for index, _, _ in jobs)
+            for index, job, source in jobs:
+                future = _submit(
+                    f"{msg['id']}:{index}",
+                    msg["module"],
+                    job["argv"],
+                    msg["useStdin"],
+                    job["cwd"],
+                    source,
+                )
+                future.add_done_callback(functools.partial(batch.job_done, index))
+
+    pool.shutdown(wait=False)
 
-        response = {"id": msg["id"], "error": result.stderr}
-        if is_exception:
-            response["exception"] = is_exception
-        elif result.stdout:
-            response["result"] = result.stdout
 
-        RPC.send_data(response)
+if __name__ == "__main__":
+    main()
@@ -11,8 +11,14 @@ import json
 import os
 import pathlib
 import sys
+import threading
+import time
 import traceback
-from typing import Any, Dict, List, Optional, Sequence
+from concurrent.futures import (CancelledError, Future, InvalidStateError,
+                                ThreadPoolExecutor)
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 
 # **********************************************************
@@ -69,6 +75,32 @@ TOOL_ARGS = []
 # Minimum version of autopep8 supported.
 MIN_VERSION = "1.7.0"
 
+# Latency budget for formatting a single statement while typing, 20
+# milliseconds unless set in the environment.
+ON_TYPE_FORMATTING_TIMEOUT = float(os.getenv("LS_ON_TYPE_FORMATTING_TIMEOUT", "0.02"))
+# Runs one at a time on its own thread. A run over the budget keeps going, and
+# later runs wait for it within their own budget, so no threads pile up.
+ON_TYPE_FORMATTING_EXECUTOR = ThreadPoolExecutor(1)
+
+# Runs autopep8 with the interpreter running this server in worker processes,
+# so that formatting does not compete with handling messages for the GIL.
+# Sized again from the `maxWorkers` setting on initialize.
+TOOL_POOL = utils.ToolProcessPool(TOOL_MODULE, utils.get_worker_count())
+
+# Backends that run autopep8 with the interpreter running this server, the
+# first one is used until the others are measured. On Linux the runner is a
+# fork server, which starts each run from a process with autopep8 imported.
+# Runs in this process hold its GIL, they are only used when the pool is broken.
+SAME_INTERPRETER_BACKENDS = (
+    ("runner", "pool") if jsonrpc.USE_FORK_SERVER else ("pool", "runner")
+)
+BACKEND_SELECTOR = utils.BackendSelector()
+
+# Gives runs of the tool slots by priority: formatting the user waits for
+# first, then formatting of many files, then idle formatting. Sized with the
+# pool.
+SCHEDULER = utils.PriorityScheduler(utils.get_worker_count())
+
 # **********************************************************
 # Formatting features start here
 # **********************************************************
@@ -82,7 +114,10 @@ def formatting(params: lsp.DocumentFormattingParams) -> Optional[List[lsp.TextEd
     return _formatting_helper(document)
 
 
-@LSP_SERVER.feature(lsp.TEXT_DOCUMENT_RANGE_FORMATTING)
+@LSP_SERVER.feature(
+    lsp.TEXT_DOCUMENT_RANGE_FORMATTING,
+    lsp.DocumentRangeFormattingOptions(ranges_support=True),
+)
 def range_formatting(
     params: lsp.DocumentRangeFormattingParams,
 ) -> Optional[List[lsp.TextEdit]]:
@@ -92,6 +127,191 @@ def range_formatting(
     return _formatting_helper(document, params.range)
 
 
+@LSP_SERVER.feature(lsp.TEXT_DOCUMENT_RANGES_FORMATTING)
+def ranges_formatting(
+    params: lsp.DocumentRangesFormattingParams,
+) -> Optional[List[lsp.TextEdit]]:
+    """LSP handler for textDocument/rangesFormatting request."""
+
+    document = LSP_SERVER.workspace.get_text_document(params.text_document.uri)
+    ranges = _merge_line_ranges(params.ranges)
+    if not ranges:
+        return None
+    if len(ranges) == 1:
+        return _formatting_helper(document, ranges[0])
+
+    # autopep8 only accepts a single `--line-range`, so format the whole document
+    # once and keep only the changes that fall inside one of the requested ranges.
+    new_source = _get_formatted_source(document)
+    if new_source is None:
+        return None
+    new_source = edit_utils.select_line_ranges(
+        document.source,
+        new_source,
+        [_get_line_range(r) for r in ranges],
+        _get_line_index(document),
+    )
+    return _get_document_edits(document, new_source)
+
+
+def _merge_line_ranges(ranges: Sequence[lsp.Range]) -> List[lsp.Range]:
+    """Returns sorted, non-overlapping line ranges covering the given ranges."""
+    merged: List[lsp.Range] = []
+    for item in sorted(ranges, key=_get_line_range):
+        first, last = _get_line_range(item)
+        if merged and first <= _get_line_range(merged[-1])[1] + 1:
+            if last > _get_line_range(merged[-1])[1]:
+                merged[-1] = lsp.Range(start=merged[-1].start, end=item.end)
+        else:
+            merged.append(item)
+    return merged
+
+
+def _get_line_range(range: lsp.Range) -> Tuple[int, int]:
+    """Returns the first and last line of the range, zero based and inclusive.
+
+    A range that ends at the start of a line, like a selection of whole lines,
+    does not include that line.
+    """
+    last = range.end.line
+    if range.end.character == 0 and last > range.start.line:
+        last -= 1
+    return range.start.line, last
+
+
+@LSP_SERVER.feature(lsp.TEXT_DOCUMENT_WILL_SAVE_WAIT_UNTIL)
+def will_save_wait_until(
+    params: lsp.WillSaveTextDocumentParams,
+) -> Optional[List[lsp.TextEdit]]:
+    """LSP handler for textDocument/willSaveWaitUntil request."""
+
+    document = LSP_SERVER.workspace.get_text_document(params.text_document.uri)
+    deadline = _get_settings_by_document(document)["saveFormattingDeadline"]
+    if deadline <= 0 or params.reason != lsp.TextDocumentSaveReason.Manual:
+        return None
+
+    # Never hold up the save beyond the deadline, saving unformatted is better.
+    end_time = time.monotonic() + deadline / 1000
+    try:
+        new_source = _get_formatted_source(document, timeout=deadline / 1000)
+    except (TimeoutError, FutureTimeoutError):
+        log_to_output(
+            f"Skipped formatting on save, not done within {deadline}ms: {document.uri}"
+        )
+        return None
+    except Exception:  # pylint: disable=broad-except
+        log_error(f"Formatting on save failed:\r\n{traceback.format_exc()}")
+        return None
+
+    if new_source is None:
+        return None
+    return _get_document_edits(
+        document, new_source, max(end_time - time.monotonic(), 0.001)
+    )
+
+
+@LSP_SERVER.feature(
+    lsp.TEXT_DOCUMENT_ON_TYPE_FORMATTING,
+    lsp.DocumentOnTypeFormattingOptions(
+        first_trigger_character="\n", more_trigger_character=[":"]
+    ),
+)
+def on_type_formatting(
+    params: lsp.DocumentOnTypeFormattingParams,
+) -> Optional[List[lsp.TextEdit]]:
+    """LSP handler for textDocument/onTypeFormatting request."""
+
+    document = LSP_SERVER.workspace.get_text_document(params.text_document.uri)
+    lines = _get_line_index(document).lines
+    if params.ch == ":":
+        # Only format when the ':' completes a compound statement header.
+        line = params.position.line
+        if line >= len(lines) or not lines[line].rstrip().endswith(":"):
+            return None
+    else:
+        line = params.position.line - 1
+        if line < 0 or line >= len(lines):
+            return None
+    return _on_type_formatting_helper(document, lines, line)
+
+
+def _on_type_formatting_helper(
+    document: workspace.Document, lines: List[str], line: int
+) -> Optional[List[lsp.TextEdit]]:
+    """Formats the logical line ending on `line` in-process, within a time budget."""
+    if utils.is_stdlib_file(document.path):
+        return None
+
+    settings = copy.deepcopy(_get_settings_by_document(document))
+    if settings["path"] not in ([], _get_default_path()) or (
+        settings["interpreter"]
+        and not utils.is_current_interpreter(settings["interpreter"][0])
+    ):
+        # Running a separate process does not fit the latency budget.
+        return None
+
+    exclude_arg, argv = _parse_autopep_exclude_arg(TOOL_ARGS + settings["args"])
+    if _is_file_in_excluded_pattern(document.path, exclude_arg):
+        return None
+
+    logical_line = edit_utils.get_logical_line(lines, line)
+    if logical_line is None:
+        return None
+    start, end = logical_line
+
+    # Format the statement on its own, nested under placeholder blocks that
+    # match its indentation.
+    old_text = "".join(lines[start : end + 1])
+    indent = old_text[: len(old_text) - len(old_text.lstrip(" \t"))]
+    unit = "\t" if indent.startswith("\t") else "    "
+    if indent != unit * (len(indent) // len(unit)):
+        return None
+    line_ending = "\r\n" if lines[start].endswith("\r\n") else "\n"
+    header = [
+        f"{unit * level}if True:{line_ending}"
+        for level in range(len(indent) // len(unit))
+    ]
+    source = "".join(header) + old_text
+
+    future = ON_TYPE_FORMATTING_EXECUTOR.submit(
+        utils.run_module,
+        module=TOOL_MODULE,
+        argv=[TOOL_MODULE] + argv + ["-"],
+        use_stdin=True,
+        cwd=get_cwd(settings, document),
+        source=source,
+    )
+    try:
+        result = future.result(ON_TYPE_FORMATTING_TIMEOUT)
+    except FutureTimeoutError:
+        # Drops the run if it has not started yet.
+        future.cancel()
+        log_to_output(f"Skipped on-type formatting over time budget: {document.uri}")
+        return None
+
+    if result.stderr or not result.stdout:
+        if result.stderr:
+            log_to_output(result.stderr)
+        return None
+
+    new_lines = result.stdout.splitlines(True)
+    if new_lines[: len(header)] != header:
+        return None
+    new_text = "".join(new_lines[len(header) :])
+    if not old_text.endswith(("\r", "\n")):
+        new_text = new_text.rstrip("\r\n")
+    if new_text == old_text:
+        return None
+
+    edits = edit_utils.get_text_edits(
+        old_text, new_text, LSP_SERVER.workspace.position_encoding
+    )
+    for edit in edits:
+        edit.range.start.line += start
+        edit.range.end.line += start
+    return edits or None
+
+
 def is_python(code: str) -> bool:
     """Ensures that the code provided is python."""
     try:
@@ -105,25 +325,76 @@ def is_python(code: str) -> bool:
 def _formatting_helper(
     document: workspace.Document, range: Optional[lsp.Range] = None
 ) -> Optional[List[lsp.TextEdit]]:
+    new_source = _get_formatted_source(document, range)
+    if new_source is None:
+        return None
+    return _get_document_edits(document, new_source)
+
+
+def _get_formatted_source(
+    document: workspace.Document,
+    range: Optional[lsp.Range] = None,
+    timeout: Optional[float] = None,
+) -> Optional[str]:
+    """Returns the formatted source, re-using results from idle formatting.
+
+    Raises `TimeoutError` if it is not done within `timeout` seconds, counting
+    the wait for an idle formatting result.
+    """
+    end_time = None if timeout is None else time.monotonic() + timeout
+    if range is None:
+        result = _get_idle_formatting_result(document)
+        if result is not None:
+            try:
+                return result.result(timeout)
+            except FutureTimeoutError as ex:
+                raise TimeoutError(f"Timed out after {timeout}s") from ex
+            except CancelledError:
+                # Idle formatting gave way to other formatting.
+                pass
+            except Exception:  # pylint: disable=broad-except
+                log_to_output(
+                    f"Idle formatting failed:\r\n{traceback.format_exc(chain=True)}"
+                )
+
+    if end_time is not None:
+        timeout = max(end_time - time.monotonic(), 0.001)
+    with FOREGROUND_FORMATTING:
+        return _run_formatter(document, range, timeout)
+
+
+def _run_formatter(
+    document: workspace.Document,
+    range: Optional[lsp.Range] = None,
+    timeout: Optional[float] = None,
+    priority: int = utils.INTERACTIVE,
+    started: Optional[Future] = None,
+) -> Optional[str]:
+    """Runs the formatter on the document and returns the formatted source.
+
+    Raises `TimeoutError` if the formatter does not finish within `timeout` seconds,
+    and `CancelledError` if a background run gives way to other formatting.
+    `started` is passed on to `_run_tool_on_document`.
+    """
     extra_args = []
     if range:
-        extra_args += [
-            "--line-range",
-            f"{range.start.line + 1}",
-            f"{range.end.line + 1}",
-        ]
-
-    result = _run_tool_on_document(document, use_stdin=True, extra_args=extra_args)
+        first, last = _get_line_range(range)
+        extra_args += ["--line-range", f"{first + 1}", f"{last + 1}"]
+
+    result = _run_tool_on_document(
+        document,
+        use_stdin=True,
+        extra_args=extra_args,
+        timeout=timeout,
+        priority=priority,
+        started=started,
+    )
 
     if result and result.stdout:
         if LSP_SERVER.lsp.trace == lsp.TraceValues.Verbose:
+            separator = "*" * 100
             log_to_output(
-                f"{document.uri} :\r\n"
-                + ("*" * 100)
-                + "\r\n"
-                + f"{result.stdout}\r\n"
-                + ("*" * 100)
-                + "\r\n"
+                f"{document.uri} :\r\n{separator}\r\n{result.stdout}\r\n{separator}\r\n"
             )
 
         new_source = _match_line_endings(document, result.stdout)
@@ -135,42 +406,271 @@ def _formatting_helper(
             elif new_source.endswith("\n"):
                 new_source = new_source[:-1]
 
-        # If code is already formatted, then no need to send any edits.
-        if new_source != document.source:
-            edits = edit_utils.get_text_edits(
-                document.source, new_source, lsp.PositionEncodingKind.Utf16
-            )
-            if edits:
-                # NOTE: If you provide [] array, VS Code will clear the file of all contents.
-                # To indicate no changes to file return None.
-                return edits
+        return new_source
     return None
 
 
-def _get_line_endings(lines: list[str]) -> str:
-    """Returns line endings used in the text."""
-    try:
-        if lines[0][-2:] == "\r\n":
-            return "\r\n"
-        return "\n"
-    except Exception:  # pylint: disable=broad-except
-        return None
+def _get_document_edits(
+    document: workspace.Document, new_source: str, timeout: Optional[float] = None
+) -> Optional[List[lsp.TextEdit]]:
+    """Returns edits to turn the document source into the new source."""
+    # If code is already formatted, then no need to send any edits.
+    if new_source != document.source:
+        settings = _get_settings_by_document(document)
+        edits = edit_utils.get_text_edits(
+            document.source,
+            new_source,
+            LSP_SERVER.workspace.position_encoding,
+            timeout,
+            settings["editMergeGap"],
+            settings["maxEdits"] or None,
+            _get_line_index(document),
+        )
+        if edits:
+            # NOTE: If you provide [] array, VS Code will clear the file of all contents.
+            # To indicate no changes to file return None.
+            return edits
+    return None
 
 
 def _match_line_endings(document: workspace.Document, text: str) -> str:
     """Ensures that the edited text line endings matches the document line endings."""
-    expected = _get_line_endings(document.source.splitlines(keepends=True))
-    actual = _get_line_endings(text.splitlines(keepends=True))
+    expected = _get_line_index(document).line_ending
+    actual = edit_utils.get_line_ending(text)
     if actual == expected or actual is None or expected is None:
         return text
     return text.replace(actual, expected)
 
 
+# Line index of each document, as of its latest version.
+LINE_INDEXES: Dict[str, edit_utils.LineIndex] = {}
+LINE_INDEXES_LOCK = threading.Lock()
+
+
+def _get_line_index(document: workspace.Document) -> edit_utils.LineIndex:
+    """Returns the line index for the document source.
+
+    Indexes are kept up to date from didChange, so the document only needs to
+    be split again if its index is missing or out of date.
+    """
+    source = document.source
+    with LINE_INDEXES_LOCK:
+        index = LINE_INDEXES.get(document.uri)
+    if index and index.version == document.version and index.size == len(source):
+        return index
+
+    index = edit_utils.LineIndex(source, document.version)
+    with LINE_INDEXES_LOCK:
+        current = LINE_INDEXES.get(document.uri)
+        if current is None or (current.version or 0) <= (document.version or 0):
+            LINE_INDEXES[document.uri] = index
+    return index
+
+
+def _update_line_index(
+    document: workspace.Document, params: lsp.DidChangeTextDocumentParams
+) -> None:
+    """Applies the changes from didChange to the document line index."""
+    with LINE_INDEXES_LOCK:
+        index = LINE_INDEXES.pop(document.uri, None)
+    if index is None:
+        jsonrpc.forget_document_changes(document.uri)
+        return
+
+    # The changes with columns in characters, for runners that have the document.
+    changes = []
+    version = index.version
+    try:
+        for change in params.content_changes:
+            if isinstance(change, lsp.TextDocumentContentChangeEvent_Type1):
+                # Same conversion as pygls used to apply the change.
+                change_range = document.position_codec.range_from_client_units(
+                    index.lines, change.range
+                )
+                start = (change_range.start.line, change_range.start.character)
+                end = (change_range.end.line, change_range.end.character)
+                index = index.updated(start, end, change.text)
+                changes.append([*start, *end, change.text])
+            else:
+                index = edit_utils.LineIndex(change.text)
+                changes.append([change.text])
+    except ValueError:
+        jsonrpc.forget_document_changes(document.uri)
+        return
+
+    index.version = params.text_document.version
+    with LINE_INDEXES_LOCK:
+        LINE_INDEXES[document.uri] = index
+    if jsonrpc.is_document_cached(document.uri):
+        jsonrpc.record_document_changes(
+            document.uri, version, index.version, changes, index.size
+        )
+    else:
+        jsonrpc.forget_document_changes(document.uri)
+
+
 # **********************************************************
 # Formatting features ends here
 # **********************************************************
 
 
+# **********************************************************
+# Idle formatting starts here
+# **********************************************************
+class ForegroundFormatting:
+    """Tracks formatting requests so that background work can yield to them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+        self._idle = threading.Event()
+        self._idle.set()
+
+    def __enter__(self):
+        with self._lock:
+            self._count += 1
+            self._idle.clear()
+
+    def __exit__(self, *_args):
+        with self._lock:
+            self._count -= 1
+            if self._count == 0:
+                self._idle.set()
+
+    def wait(self) -> None:
+        """Blocks while any formatting request is running."""
+        self._idle.wait()
+
+
+FOREGROUND_FORMATTING = ForegroundFormatting()
+
+# Latest idle formatting result for each document uri, as (source, result).
+IDLE_FORMATTING_RESULTS: Dict[str, Tuple[str, Future]] = {}
+IDLE_FORMATTING_TIMERS: Dict[str, threading.Timer] = {}
+IDLE_FORMATTING_LOCK = threading.Lock()
+
+
+@LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_CHANGE)
+def did_change(params: lsp.DidChangeTextDocumentParams) -> None:
+    """LSP handler for textDocument/didChange notification."""
+    document = LSP_SERVER.workspace.get_text_document(params.text_document.uri)
+    _update_line_index(document, params)
+    _schedule_idle_formatting(document)
+
+
+@LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_CLOSE)
+def did_close(params: lsp.DidCloseTextDocumentParams) -> None:
+    """LSP handler for textDocument/didClose notification."""
+    with LINE_INDEXES_LOCK:
+        LINE_INDEXES.pop(params.text_document.uri, None)
+    jsonrpc.close_document(params.text_document.uri)
+    with IDLE_FORMATTING_LOCK:
+        timer = IDLE_FORMATTING_TIMERS.pop(params.text_document.uri, None)
+        if timer:
+            timer.cancel()
+        IDLE_FORMATTING_RESULTS.pop(params.text_document.uri, None)
+
+
+def _schedule_idle_formatting(document: workspace.Document) -> None:
+    """(Re)starts the idle timer that formats the latest version of the document."""
+    delay = _get_settings_by_document(document)["idleFormattingDelay"]
+    with IDLE_FORMATTING_LOCK:
+        timer = IDLE_FORMATTING_TIMERS.pop(document.uri, None)
+        if timer:
+            timer.cancel()
+
+        # Results for older versions of the document are no longer useful.
+        result = IDLE_FORMATTING_RESULTS.get(document.uri)
+        if result and result[0] is not document.source:
+            del IDLE_FORMATTING_RESULTS[document.uri]
+
+        if delay > 0:
+            timer = threading.Timer(
+                delay / 1000, _run_idle_formatting, (document.uri, document.version)
+            )
+            timer.daemon = True
+            IDLE_FORMATTING_TIMERS[document.uri] = timer
+            timer.start()
+
+
+def _run_idle_formatting(uri: str, version: Optional[int]) -> None:
+    """Formats the document in the background and keeps the result."""
+    FOREGROUND_FORMATTING.wait()
+
+    document = LSP_SERVER.workspace.get_text_document(uri)
+    source = document.source
+    if document.version != version:
+        return
+
+    result = Future()
+    with IDLE_FORMATTING_LOCK:
+        if IDLE_FORMATTING_TIMERS.get(uri) is not threading.current_thread():
+            # Document was changed or closed again.
+            return
+        del IDLE_FORMATTING_TIMERS[uri]
+        IDLE_FORMATTING_RESULTS[uri] = (source, result)
+
+    # Work on a snapshot, the document is updated in place on changes.
+    # The result stays pending until the run has a slot, so that requests do
+    # not wait behind queued background work.
+    snapshot = workspace.Document(uri, source=source, version=version)
+    try:
+        new_source = _run_formatter(
+            snapshot, priority=utils.BACKGROUND, started=result
+        )
+    except CancelledError as ex:
+        # Other formatting needed the slot, the next request formats again.
+        _forget_idle_formatting_result(uri, result)
+        _set_idle_formatting_result(result, exception=ex)
+    except Exception as ex:  # pylint: disable=broad-except
+        _set_idle_formatting_result(result, exception=ex)
+    else:
+        _set_idle_formatting_result(result, new_source)
+
+
+def _set_idle_formatting_result(
+    result: Future,
+    new_source: Optional[str] = None,
+    exception: Optional[BaseException] = None,
+) -> None:
+    """Sets the result, unless a request cancelled it while it was pending."""
+    try:
+        if exception is not None:
+            result.set_exception(exception)
+        else:
+            result.set_result(new_source)
+    except InvalidStateError:
+        pass
+
+
+def _get_idle_formatting_result(document: workspace.Document) -> Optional[Future]:
+    """Returns the idle formatting result for the current document source, if any.
+
+    A result that is still waiting for a slot is cancelled instead, running
+    the formatter at the priority of the request is faster than waiting.
+    """
+    with IDLE_FORMATTING_LOCK:
+        result = IDLE_FORMATTING_RESULTS.get(document.uri)
+    if not result or result[0] != document.source:
+        return None
+    if result[1].cancel():
+        _forget_idle_formatting_result(document.uri, result[1])
+        return None
+    return result[1]
+
+
+def _forget_idle_formatting_result(uri: str, result: Future) -> None:
+    """Removes the idle formatting result of the document, if it is still `result`."""
+    with IDLE_FORMATTING_LOCK:
+        if IDLE_FORMATTING_RESULTS.get(uri, (None, None))[1] is result:
+            del IDLE_FORMATTING_RESULTS[uri]
+
+
+# **********************************************************
+# Idle formatting ends here
+# **********************************************************
+
+
 # **********************************************************
 # Required Language Server Initialization and Exit handlers.
 # **********************************************************
@@ -200,18 +700,30 @@ def initialize(params: lsp.InitializeParams) -> None:
 
     _log_version_info()
     _check_args()
+    TOOL_POOL.resize(_get_max_workers())
+    SCHEDULER.resize(_get_max_workers())
+    jsonrpc.configure_runners(
+        GLOBAL_SETTINGS.get("runnerIdleTimeout", jsonrpc.RUNNER_IDLE_TIMEOUT),
+        GLOBAL_SETTINGS.get("runnerMaxRuns", jsonrpc.RUNNER_MAX_RUNS),
+        GLOBAL_SETTINGS.get("runnerMaxMemory", jsonrpc.RUNNER_MAX_MEMORY),
+    )
+    if not jsonrpc.USE_FORK_SERVER:
+        # Start the pool used for the default path ahead of the first formatting.
+        TOOL_POOL.start()
 
 
 @LSP_SERVER.feature(lsp.EXIT)
 def on_exit(_params: Optional[Any] = None) -> None:
     """Handle clean up on exit."""
     jsonrpc.shutdown_json_rpc()
+    TOOL_POOL.shutdown()
 
 
 @LSP_SERVER.feature(lsp.SHUTDOWN)
 def on_shutdown(_params: Optional[Any] = None) -> None:
     """Handle clean up on shutdown."""
     jsonrpc.shutdown_json_rpc()
+    TOOL_POOL.shutdown()
 
 
 def _check_args() -> None:
@@ -285,18 +797,28 @@ def _get_global_defaults():
         "args": GLOBAL_SETTINGS.get("args", []),
         "importStrategy": GLOBAL_SETTINGS.get("importStrategy", "useBundled"),
         "showNotifications": GLOBAL_SETTINGS.get("showNotifications", "off"),
+        "idleFormattingDelay": GLOBAL_SETTINGS.get("idleFormattingDelay", 0),
+        "saveFormattingDeadline": GLOBAL_SETTINGS.get("saveFormattingDeadline", 0),
+        "editMergeGap": GLOBAL_SETTINGS.get("editMergeGap", 8),
+        "maxEdits": GLOBAL_SETTINGS.get("maxEdits", 1000),
     }
     if not settings["path"]:
         # workaround for reload issue with autopep8
         # https://github.com/hhatto/autopep8/issues/625
-        settings["path"] = [
-            sys.executable,
-            "-m",
-            TOOL_MODULE,
-        ]
+        settings["path"] = _get_default_path()
     return settings
 
 
+def _get_max_workers() -> int:
+    """Returns the number of autopep8 runs at the same time in a pool."""
+    return utils.get_worker_count(GLOBAL_SETTINGS.get("maxWorkers", 0))
+
+
+def _get_default_path() -> List[str]:
+    """Returns `path` used to run autopep8 with the interpreter running this server."""
+    return [sys.executable, "-m", TOOL_MODULE]
+
+
 def _update_workspace_settings(settings):
     if not settings:
         key = utils.normalize_path(os.getcwd())
@@ -317,11 +839,7 @@ def _update_workspace_settings(settings):
         if not WORKSPACE_SETTINGS[key]["path"]:
             # workaround for reload issue with autopep8
             # https://github.com/hhatto/autopep8/issues/625
-            WORKSPACE_SETTINGS[key]["path"] = [
-                sys.executable,
-                "-m",
-                TOOL_MODULE,
-            ]
+            WORKSPACE_SETTINGS[key]["path"] = _get_default_path()
 
 
 def _get_settings_by_path(file_path: pathlib.Path):
@@ -405,11 +923,19 @@ def _run_tool_on_document(
     document: workspace.Document,
     use_stdin: bool = False,
     extra_args: Sequence[str] = [],
+    timeout: Optional[float] = None,
+    priority: int = utils.INTERACTIVE,
+    started: Optional[Future] = None,
 ) -> Optional[utils.RunResult]:
     """Runs tool on the given document.
 
     if use_stdin is true then contents of the document is passed to the
-    tool via stdin.
+    tool via stdin. If the tool does not finish within `timeout` seconds, the
+    run is abandoned (killing the tool process where there is one) and
+    `TimeoutError` is raised. The run waits for a slot of the scheduler with
+    the given priority, and raises `CancelledError` if it is preempted. If
+    `started` is given it is set running once the run has a slot, and if it
+    was cancelled while waiting the run is skipped with `CancelledError`.
     """
     if utils.is_stdlib_file(document.path):
         log_warning(f"Skipping standard library file: {document.path}")
@@ -427,23 +953,34 @@ def _run_tool_on_document(
     code_workspace = settings["workspaceFS"]
     cwd = get_cwd(settings, document)
 
-    use_path = False
-    use_rpc = False
-    if settings["path"]:
-        # 'path' setting takes priority over everything.
-        use_path = True
+    interpreter = settings["interpreter"]
+    selection_key = None
+    if settings["path"] and (
+        settings["path"] != _get_default_path()
+        or settings["importStrategy"] != "useBundled"
+    ):
+        # 'path' setting takes priority over everything. The default path also
+        # runs as a subprocess when autopep8 comes from the environment, which
+        # can differ from the one imported by this server.
         argv = settings["path"]
-    elif settings["interpreter"] and not utils.is_current_interpreter(
-        settings["interpreter"][0]
+        backend = "path"
+    elif (
+        not settings["path"]
+        and settings["interpreter"]
+        and not utils.is_current_interpreter(settings["interpreter"][0])
     ):
         # If there is a different interpreter set use JSON-RPC to the subprocess
         # running under that interpreter.
         argv = [TOOL_MODULE]
-        use_rpc = True
+        backend = "runner"
     else:
-        # if the interpreter is same as the interpreter running this
-        # process then run as module.
+        # The default path, or the interpreter running this server, can run in
+        # the runner or in the process pool. The one that is fastest for the
+        # workspace and document size is used.
         argv = [TOOL_MODULE]
+        interpreter = [sys.executable]
+        selection_key = (code_workspace, _get_size_bucket(document.source))
+        backend = BACKEND_SELECTOR.select(selection_key, SAME_INTERPRETER_BACKENDS)
 
     argv += TOOL_ARGS + settings["args"] + extra_args
 
@@ -459,7 +996,57 @@ def _run_tool_on_document(
         argv = remaining_arg_list
         argv += ["-"]
 
-    if use_path:
+    with SCHEDULER.run(priority, code_workspace) as scheduled:
+        if started is not None and not started.set_running_or_notify_cancel():
+            raise CancelledError()
+        start = time.monotonic()
+        try:
+            result = _run_backend(
+                backend,
+                document,
+                settings,
+                interpreter,
+                argv,
+                use_stdin,
+                cwd,
+                timeout,
+                scheduled.cancelled,
+            )
+        except TimeoutError:
+            if selection_key is not None:
+                BACKEND_SELECTOR.record(
+                    selection_key, backend, time.monotonic() - start
+                )
+            raise
+    if selection_key is not None:
+        BACKEND_SELECTOR.record(selection_key, backend, time.monotonic() - start)
+    return result
+
+
+def _get_size_bucket(source: str) -> int:
+    """Returns the size bucket of a document, one for each factor of 4 over 1KiB."""
+    return ((len(source) >> 10).bit_length() + 1) // 2
+
+
+# pylint: disable=too-many-arguments
+def _run_backend(
+    backend: str,
+    document: workspace.Document,
+    settings: Dict[str, Any],
+    interpreter: Sequence[str],
+    argv: Sequence[str],
+    use_stdin: bool,
+    cwd: str,
+    timeout: Optional[float],
+    cancel: Optional[Future] = None,
+) -> utils.RunResult:
+    """Runs the tool on the document with the given backend.
+
+    Once `cancel` is done, runs in the runner are stopped. Runs in the pool
+    are dropped if they have not started, otherwise they keep going in their
+    worker and only the wait for them ends.
+    """
+    if backend == "path":
         # This mode is used when running executables.
         log_to_output(" ".join(argv))
         log_to_output(f"CWD Server: {cwd}")
@@ -471,18 +1058,19 @@ def _run_tool_on_document(
             env={
                 "PYTHONUTF8": "1",
             },
+            timeout=timeout,
         )
         if result.stderr:
             log_to_output(result.stderr)
-    elif use_rpc:
+    elif backend == "runner":
         # This mode is used if the interpreter running this server is different from
-        # the interpreter used for running this server.
-        log_to_output(" ".join(settings["interpreter"] + ["-m"] + argv))
+        # the interpreter used for running this server, or to use the fork server.
+        log_to_output(" ".join(list(interpreter) + ["-m"] + argv))
         log_to_output(f"CWD formatter: {cwd}")
 
         result = jsonrpc.run_over_json_rpc(
-            workspace=code_workspace,
-            interpreter=settings["interpreter"],
+            workspace=settings["workspaceFS"],
+            interpreter=interpreter,
             module=TOOL_MODULE,
             argv=argv,
             use_stdin=use_stdin,
@@ -490,28 +1078,55 @@ def _run_tool_on_document(
             source=document.source,
             env={
                 "LS_IMPORT_STRATEGY": settings["importStrategy"],
+                "LS_MAX_WORKERS": str(_get_max_workers()),
                 "PYTHONUTF8": "1",
             },
+            timeout=timeout,
+            uri=document.uri,
+            version=document.version,
+            cancel=cancel,
         )
         result = _to_run_result_with_logging(result)
     else:
-        # In this mode the tool is run as a module in the same process as the language server.
+        # In this mode the tool is run as a module with the interpreter running the
+        # language server, in a worker process of the pool.
         log_to_output(" ".join([sys.executable, "-m"] + argv))
         log_to_output(f"CWD formatter: {cwd}")
-        # This is needed to preserve sys.path, in cases where the tool modifies
-        # sys.path and that might not work for this scenario next time around.
-        with utils.substitute_attr(sys, "path", [""] + sys.path[:]):
+        source = document.source
+
+        def _run_module() -> utils.RunResult:
+            # Runs in other threads can run at the same time, the tool is run
+            # with its own arguments and streams.
             try:
-                result = utils.run_module(
+                return utils.run_module(
                     module=TOOL_MODULE,
                     argv=argv,
                     use_stdin=use_stdin,
                     cwd=cwd,
-                    source=document.source,
+                    source=source,
                 )
             except Exception:
                 log_error(traceback.format_exc(chain=True))
                 raise
+
+        try:
+            result = TOOL_POOL.run_module(
+                argv=argv,
+                use_stdin=use_stdin,
+                cwd=cwd,
+                source=source,
+                timeout=timeout,
+                cancel=cancel,
+            )
+        except (TimeoutError, CancelledError):
+            raise
+        except BrokenProcessPool:
+            # A worker died, run in this process while the pool starts again.
+            log_error(traceback.format_exc(chain=True))
+            result = utils.run_with_timeout(_run_module, timeout)
+        except Exception:
+            log_error(traceback.format_exc(chain=True))
+            raise
         if result.stderr:
             log_to_output(result.stderr)
 
@@ -571,6 +1186,7 @@ def _run_tool(extra_args: Sequence[str], settings: Dict[str, Any]) -> utils.RunR
             cwd=cwd,
             env={
                 "LS_IMPORT_STRATEGY": settings["importStrategy"],
+                "LS_MAX_WORKERS": str(_get_max_workers()),
                 "PYTHONUTF8": "1",
             },
         )
@@ -579,16 +1195,13 @@ def _run_tool(extra_args: Sequence[str], settings: Dict[str, Any]) -> utils.RunR
         # In this mode the tool is run as a module in the same process as the language server.
         log_to_output(" ".join([sys.executable, "-m"] + argv))
         log_to_output(f"CWD formatter: {cwd}")
-        # This is needed to preserve sys.path, in cases where the tool modifies
-        # sys.path and that might not work for this scenario next time around.
-        with utils.substitute_attr(sys, "path", [""] + sys.path[:]):
-            try:
-                result = utils.run_module(
-                    module=TOOL_MODULE, argv=argv, use_stdin=True, cwd=cwd
-                )
-            except Exception:
-                log_error(traceback.format_exc(chain=True))
-                raise
+        try:
+            result = utils.run_module(
+                module=TOOL_MODULE, argv=argv, use_stdin=True, cwd=cwd
+            )
+        except Exception:
+            log_error(traceback.format_exc(chain=True))
+            raise
         if result.stderr:
             log_to_output(result.stderr)
 
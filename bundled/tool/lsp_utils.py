@@ -3,9 +3,12 @@
 """Utility functions and classes for use with running tools over LSP."""
 from __future__ import annotations
 
+import concurrent.futures
 import contextlib
 import importlib
 import io
+import math
+import multiprocessing
 import os
 import pathlib
 import runpy
@@ -14,12 +17,14 @@ import subprocess
 import sys
 import sysconfig
 import threading
+import time
 import traceback
+from concurrent.futures.process import BrokenProcessPool
+from types import ModuleType
 from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 # Save the working directory used when loading this module
 SERVER_CWD = os.getcwd()
-CWD_LOCK = threading.Lock()
 
 
 def as_list(content: Union[Any, List[Any], Tuple[Any]]) -> List[Any]:
@@ -101,6 +106,7 @@ class CustomIO(io.TextIOWrapper):
     def __init__(self, name, encoding="utf-8", newline=None):
         self._buffer = io.BytesIO()
         self._buffer.name = name
+        self._newline = newline
         super().__init__(self._buffer, encoding=encoding, newline=newline)
 
     def close(self):
@@ -109,8 +115,59 @@ class CustomIO(io.TextIOWrapper):
 
     def get_value(self) -> str:
         """Returns value from the buffer as string."""
-        self.seek(0)
-        return self.read()
+        self.flush()
+        # Decode straight from the buffer instead of reading a copy of it.
+        with self._buffer.getbuffer() as data:
+            value = str(data, self.encoding)
+        if self._newline is None:
+            # Same translation as reading with universal newlines, this does
+            # not copy the string when there is nothing to replace.
+            value = value.replace("\r\n", "\n").replace("\r", "\n")
+        return value
+
+
+class StringInput(io.TextIOBase):
+    """Read only stream over a string, used to replace stdin.
+
+    Reading all of it returns the string itself instead of a copy.
+    """
+
+    def __init__(self, name, value: str, encoding="utf-8"):
+        super().__init__()
+        self.name = name
+        self._value = value
+        self._position = 0
+        self._encoding = encoding
+
+    @property
+    def encoding(self) -> str:
+        """Encoding of the stream."""
+        return self._encoding
+
+    @property
+    def buffer(self) -> io.BytesIO:
+        """Binary stream over the rest of the string, for tools that read bytes."""
+        return io.BytesIO(self.read().encode(self._encoding))
+
+    def readable(self) -> bool:
+        """Returns True, the stream can be read."""
+        return True
+
+    def read(self, size: Optional[int] = -1) -> str:
+        """Reads up to size characters, or the rest of the string."""
+        start = self._position
+        if size is None or size < 0:
+            self._position = len(self._value)
+        else:
+            self._position = min(start + size, len(self._value))
+        return self._value[start : self._position]
+
+    def readline(self, size: Optional[int] = -1) -> str:
+        """Reads up to and including the next new line."""
+        end = self._value.find("\n", self._position) + 1 or len(self._value)
+        if size is not None and size >= 0:
+            end = min(end, self._position + size)
+        return self.read(end - self._position)
 
 
 @contextlib.contextmanager
@@ -118,8 +175,10 @@ def substitute_attr(obj: Any, attribute: str, new_value: Any):
     """Manage object attributes context when using runpy.run_module()."""
     old_value = getattr(obj, attribute)
     setattr(obj, attribute, new_value)
-    yield
-    setattr(obj, attribute, old_value)
+    try:
+        yield
+    finally:
+        setattr(obj, attribute, old_value)
 
 
 @contextlib.contextmanager
@@ -127,16 +186,192 @@ def redirect_io(stream: str, new_stream):
     """Redirect stdio streams to a custom stream."""
     old_stream = getattr(sys, stream)
     setattr(sys, stream, new_stream)
-    yield
-    setattr(sys, stream, old_stream)
+    try:
+        yield
+    finally:
+        setattr(sys, stream, old_stream)
 
 
 @contextlib.contextmanager
 def change_cwd(new_cwd):
     """Change working directory before running code."""
     os.chdir(new_cwd)
-    yield
-    os.chdir(SERVER_CWD)
+    try:
+        yield
+    finally:
+        os.chdir(SERVER_CWD)
+
+
+# Streams set for the current thread by thread_stdio().
+_THREAD_STDIO = threading.local()
+_THREAD_STDIO_LOCK = threading.Lock()
+
+
+class ThreadLocalStream:
+    """Stands in for a stdio stream, using the stream set for the current thread.
+
+    Threads that did not set a stream use the stream this one replaced, so
+    output of other threads, like logging, is not captured by a run.
+    """
+
+    def __init__(self, name: str, default):
+        self._name = name
+        self._default = default
+
+    def _stream(self):
+        return getattr(_THREAD_STDIO, self._name, None) or self._default
+
+    def __getattr__(self, attribute: str) -> Any:
+        return getattr(self._stream(), attribute)
+
+    def __iter__(self):
+        return iter(self._stream())
+
+
+@contextlib.contextmanager
+def thread_stdio(stdout, stderr, stdin=None):
+    """Sets the stdio streams of the current thread only."""
+    with _THREAD_STDIO_LOCK:
+        for name in ("stdin", "stdout", "stderr"):
+            stream = getattr(sys, name)
+            if not isinstance(stream, ThreadLocalStream):
+                setattr(sys, name, ThreadLocalStream(name, stream))
+
+    old_streams = vars(_THREAD_STDIO).copy()
+    _THREAD_STDIO.stdout = stdout
+    _THREAD_STDIO.stderr = stderr
+    _THREAD_STDIO.stdin = stdin
+    try:
+        yield
+    finally:
+        vars(_THREAD_STDIO).clear()
+        vars(_THREAD_STDIO).update(old_streams)
+
+
+class WorkingDirectory:
+    """Working directory shared by runs in this process.
+
+    Runs that use the same directory run at the same time. A run that needs
+    another directory waits for the current runs to finish, and runs that
+    start after it wait for it.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._users = 0
+        self._waiting = 0
+
+    @contextlib.contextmanager
+    def use(self, cwd: str):
+        """Changes to the given directory for the duration of a run."""
+        with self._condition:
+            if self._users and (self._waiting or not is_same_path(os.getcwd(), cwd)):
+                self._waiting += 1
+                try:
+                    self._condition.wait_for(lambda: not self._users)
+                finally:
+                    self._waiting -= 1
+            if not is_same_path(os.getcwd(), cwd):
+                os.chdir(cwd)
+            self._users += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._users -= 1
+                if not self._users:
+                    if not self._waiting and not is_same_path(os.getcwd(), SERVER_CWD):
+                        os.chdir(SERVER_CWD)
+                    self._condition.notify_all()
+
+
+WORKING_DIRECTORY = WorkingDirectory()
+# Runs that use runpy also share sys.argv and sys.path.
+RUNPY_LOCK = threading.Lock()
+
+
+# autopep8 changes module level state when run as a script, so running it
+# again in the same process can fail: https://github.com/hhatto/autopep8/issues/625
+# Instead it is imported once and run through its API, which only shares the
+# checks registry, saved after import to restore it if changed, and a
+# tokenizer cache, made local to each thread. It is reloaded only when the
+# installed autopep8 changes.
+_TOOL_STATE: Dict[str, Tuple[Tuple[Any, ...], Dict[str, Any]]] = {}
+_TOOL_STATE_LOCK = threading.Lock()
+
+
+def _get_tool_stamp(tool: ModuleType) -> Tuple[Any, ...]:
+    """Returns what identifies the installed version of the tool."""
+    try:
+        stat = os.stat(tool.__file__)
+        file_stamp = (stat.st_mtime_ns, stat.st_size)
+    except (OSError, TypeError):
+        file_stamp = None
+    return (tool.__file__, file_stamp)
+
+
+def _copy_checks(checks: Dict[str, Dict[Any, Tuple[List[str], Any]]]) -> Dict:
+    return {
+        kind: {check: (list(codes), args) for check, (codes, args) in registry.items()}
+        for kind, registry in checks.items()
+    }
+
+
+def _use_thread_local_tokenizer(tool: ModuleType) -> threading.local:
+    """Replaces the tokenizer cache of autopep8 with one for each thread."""
+    tokenizers = threading.local()
+
+    def generate_tokens(text):
+        if not hasattr(tokenizers, "tokenizer"):
+            tokenizers.tokenizer = tool.CachedTokenizer()
+        return tokenizers.tokenizer.generate_tokens(text)
+
+    tool.generate_tokens = generate_tokens
+    return tokenizers
+
+
+def _prepare_tool(module: str) -> ModuleType:
+    """Imports the tool, reloading it only if the installed version changed."""
+    with _TOOL_STATE_LOCK:
+        tool = importlib.import_module(module)
+        stamp = _get_tool_stamp(tool)
+        saved = _TOOL_STATE.get(module)
+        if saved is None or saved[0] != stamp:
+            if saved is not None:
+                tool = importlib.reload(tool)
+            state = {
+                "tokenizers": _use_thread_local_tokenizer(tool),
+                # pylint: disable-next=protected-access
+                "checks": _copy_checks(tool.pycodestyle._checks),
+            }
+            _TOOL_STATE[module] = (stamp, state)
+        return tool
+
+
+def _restore_tool_state(tool: ModuleType, state: Dict[str, Any]) -> None:
+    """Restores the state of autopep8 saved after import, if it changed."""
+    # Not kept past the run, the source can be large.
+    vars(state["tokenizers"]).clear()
+
+    checks = tool.pycodestyle._checks  # pylint: disable=protected-access
+    if checks != state["checks"]:
+        with _TOOL_STATE_LOCK:
+            checks.clear()
+            checks.update(_copy_checks(state["checks"]))
+
+
+def _run_autopep8(
+    tool: ModuleType, argv: Sequence[str], source: Optional[str], stdout: CustomIO
+) -> None:
+    """Runs autopep8 like its main(), with explicit arguments and streams."""
+    args = tool.parse_args(argv[1:], apply_config=True)
+    if args.list_fixes:
+        for code, description in sorted(tool.supported_fixes()):
+            stdout.write(f"{code} - {description}\n")
+    elif args.files == ["-"]:
+        stdout.write(tool.fix_code(source or "", args))
+    else:
+        tool.fix_multiple_files(args.files, args, stdout)
 
 
 def _run_module(
@@ -145,32 +380,35 @@ def _run_module(
     """Runs as a module."""
     str_output = CustomIO("<stdout>", encoding="utf-8")
     str_error = CustomIO("<stderr>", encoding="utf-8")
-
-    try:
-        with substitute_attr(sys, "argv", argv):
-            with redirect_io("stdout", str_output):
-                with redirect_io("stderr", str_error):
-                    try:
-                        import autopep8
-
-                        importlib.reload(autopep8)
-                    except:
-                        str_error.write(
-                            "Mitigation for `autopep8` issue failed: https://github.com/hhatto/autopep8/issues/625"
-                        )
-                        str_error.write(
-                            f"Error reloading autopep8: {traceback.format_exc()}\n"
-                        )
-                    if use_stdin and source is not None:
-                        str_input = CustomIO("<stdin>", encoding="utf-8", newline="\n")
-                        with redirect_io("stdin", str_input):
-                            str_input.write(source)
-                            str_input.seek(0)
-                            runpy.run_module(module, run_name="__main__")
-                    else:
+    str_input = None
+    if use_stdin and source is not None:
+        str_input = StringInput("<stdin>", source, encoding="utf-8")
+
+    tool = None
+    with thread_stdio(str_output, str_error, str_input):
+        if module == "autopep8":
+            try:
+                tool = _prepare_tool(module)
+            except:
+                str_error.write(
+                    "Mitigation for `autopep8` issue failed: https://github.com/hhatto/autopep8/issues/625"
+                )
+                str_error.write(f"Error preparing autopep8: {traceback.format_exc()}\n")
+
+        try:
+            if tool is not None:
+                try:
+                    _run_autopep8(tool, argv, source if use_stdin else None, str_output)
+                finally:
+                    _restore_tool_state(tool, _TOOL_STATE[module][1])
+            else:
+                # This is needed to preserve sys.path, in cases where the tool
+                # modifies sys.path and that might not work next time around.
+                with RUNPY_LOCK, substitute_attr(sys, "argv", argv):
+                    with substitute_attr(sys, "path", [""] + sys.path[:]):
                         runpy.run_module(module, run_name="__main__")
-    except SystemExit:
-        pass
+        except SystemExit:
+            pass
 
     return RunResult(str_output.get_value(), str_error.get_value())
 
@@ -178,12 +416,399 @@ def _run_module(
 def run_module(
     module: str, argv: Sequence[str], use_stdin: bool, cwd: str, source: str = None
 ) -> RunResult:
-    """Runs as a module."""
-    with CWD_LOCK:
-        if is_same_path(os.getcwd(), cwd):
-            return _run_module(module, argv, use_stdin, source)
-        with change_cwd(cwd):
-            return _run_module(module, argv, use_stdin, source)
+    """Runs as a module.
+
+    Runs of autopep8 in the same working directory can run at the same time
+    on different threads.
+    """
+    with WORKING_DIRECTORY.use(cwd):
+        return _run_module(module, argv, use_stdin, source)
+
+
+def get_cpu_count() -> int:
+    """Returns the number of processors this process can run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+
+def get_worker_count(configured: int = 0) -> int:
+    """Returns the number of runs of the tool at the same time.
+
+    `configured` is used when greater than 0. Otherwise there is a run for
+    each processor but one, so that the editor and the server keep a
+    processor, and at least two, so that a short run does not wait for a long
+    one.
+    """
+    if configured > 0:
+        return configured
+    return max(2, get_cpu_count() - 1)
+
+
+def detach_stdio() -> None:
+    """Points stdin and stdout of this process at the null device.
+
+    Used in worker processes, which capture the output of the tool in memory
+    and should not write to or keep open the pipes of the process that
+    started them.
+    """
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, sys.stdin.fileno())
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+
+
+def exit_with_parent(parent_pid: int) -> None:
+    """Exits this worker process once the process that started it is gone.
+
+    Workers of a process pool do not notice when their parent is killed, as
+    they share the pipes of the pool with each other.
+    """
+
+    def _watch():
+        if sys.platform == "win32":
+            multiprocessing.parent_process().join()
+        else:
+            while os.getppid() == parent_pid:
+                time.sleep(1)
+        os._exit(0)  # pylint: disable=protected-access
+
+    threading.Thread(target=_watch, daemon=True).start()
+
+
+def init_pool_worker(parent_pid: int, module: str) -> None:
+    """Initializes a worker of ToolProcessPool, importing the tool ahead of runs."""
+    detach_stdio()
+    exit_with_parent(parent_pid)
+    try:
+        if module == "autopep8":
+            _prepare_tool(module)
+        else:
+            importlib.import_module(module)
+    except Exception:  # pylint: disable=broad-except
+        # Reported by the first run.
+        pass
+
+
+class ToolProcessPool:
+    """Runs the tool in worker processes of this interpreter.
+
+    Workers import the tool when they start, so a run costs about as much as
+    a run in this process, without holding the GIL of this process. Workers
+    are started with spawn on all platforms, as this process has threads.
+    A worker is started when a run would otherwise wait, up to `max_workers`,
+    and all of them stop once the pool is idle for `idle_timeout` seconds.
+    """
+
+    def __init__(self, module: str, max_workers: int, idle_timeout: float = 300):
+        self._module = module
+        self._max_workers = max_workers
+        self._idle_timeout = idle_timeout
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._pending = 0
+        self._idle_timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._lock:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    self._max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_pool_worker,
+                    initargs=(os.getpid(), self._module),
+                )
+            self._pending += 1
+            return self._executor
+
+    def _run_done(self, _future=None) -> None:
+        with self._lock:
+            self._pending -= 1
+            if self._pending or self._executor is None:
+                return
+            self._idle_timer = threading.Timer(self._idle_timeout, self._stop_if_idle)
+            self._idle_timer.daemon = True
+            self._idle_timer.start()
+
+    def _stop_if_idle(self) -> None:
+        with self._lock:
+            if self._pending or self._idle_timer is None:
+                return
+            executor, self._executor = self._executor, None
+            self._idle_timer = None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def resize(self, max_workers: int) -> None:
+        """Changes the number of workers, running workers stop after their runs."""
+        with self._lock:
+            if max_workers == self._max_workers:
+                return
+            self._max_workers = max_workers
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def start(self) -> None:
+        """Starts a worker ahead of the first run."""
+        self._get_executor().submit(int).add_done_callback(self._run_done)
+
+    def run_module(
+        self,
+        argv: Sequence[str],
+        use_stdin: bool,
+        cwd: str,
+        source: str = None,
+        timeout: Optional[float] = None,
+        cancel: Optional[concurrent.futures.Future] = None,
+    ) -> RunResult:
+        """Runs as a module in a worker process.
+
+        If the run does not finish within `timeout` seconds `TimeoutError` is
+        raised, and the run keeps going in its worker. If `cancel` is done
+        first `CancelledError` is raised the same way. If a worker dies, the
+        pool is started again on the next run and `BrokenProcessPool` is raised.
+        """
+        executor = self._get_executor()
+        try:
+            future = executor.submit(
+                run_module, self._module, argv, use_stdin, cwd, source
+            )
+        except BaseException:
+            self._run_done()
+            raise
+        future.add_done_callback(self._run_done)
+        try:
+            if cancel is not None:
+                concurrent.futures.wait(
+                    (future, cancel), timeout, concurrent.futures.FIRST_COMPLETED
+                )
+                if cancel.done() and not future.done():
+                    future.cancel()
+                    raise concurrent.futures.CancelledError()
+            # The wait above already took up the timeout.
+            return future.result(timeout if cancel is None else 0)
+        except concurrent.futures.TimeoutError as ex:
+            future.cancel()
+            raise TimeoutError(f"Timed out after {timeout}s") from ex
+        except BrokenProcessPool:
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False)
+            raise
+
+    def shutdown(self) -> None:
+        """Stops the workers once their runs are done."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+# Buckets of a latency histogram, four for each doubling of the latency from
+# 1 millisecond up to about a minute.
+LATENCY_BUCKETS_PER_DOUBLING = 4
+LATENCY_BUCKETS = 64
+# Counts of a histogram are halved when they reach this total, so that recent
+# runs weigh more than old ones.
+LATENCY_HISTOGRAM_MAX_COUNT = 64
+
+
+class LatencyHistogram:
+    """Counts of run latencies, in buckets that grow geometrically."""
+
+    def __init__(self):
+        self.counts = [0] * LATENCY_BUCKETS
+        self.total = 0
+
+    def add(self, seconds: float) -> None:
+        """Counts a run that took the given time."""
+        milliseconds = max(seconds * 1000, 1.0)
+        bucket = int(math.log2(milliseconds) * LATENCY_BUCKETS_PER_DOUBLING)
+        self.counts[min(bucket, LATENCY_BUCKETS - 1)] += 1
+        self.total += 1
+        if self.total >= LATENCY_HISTOGRAM_MAX_COUNT:
+            self.counts = [count // 2 for count in self.counts]
+            self.total = sum(self.counts)
+
+    def percentile(self, fraction: float) -> float:
+        """Returns the latency in seconds below which the fraction of runs fall."""
+        target = fraction * self.total
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return 2 ** ((bucket + 0.5) / LATENCY_BUCKETS_PER_DOUBLING) / 1000
+        return math.inf
+
+
+class BackendSelector:
+    """Picks the fastest of equivalent backends from their measured latency.
+
+    Latencies are kept for each key, like a workspace and a document size.
+    The first backend given is used until the others are measured: one run in
+    `explore_interval` goes to another backend, until each has `min_samples`
+    runs. After that the backend with the lowest median latency is used, and
+    some runs still go to the backend that was used least recently, so that
+    changes in latency are noticed. The interval between those runs doubles
+    each time, up to `max_explore_interval`. The first run of each backend for
+    a key is not counted, it includes starting the backend.
+    """
+
+    def __init__(
+        self,
+        min_samples: int = 3,
+        explore_interval: int = 10,
+        max_explore_interval: int = 640,
+    ):
+        self._min_samples = min_samples
+        self._explore_interval = explore_interval
+        self._max_explore_interval = max_explore_interval
+        self._histograms: Dict[Any, Dict[str, LatencyHistogram]] = {}
+        self._runs: Dict[Any, int] = {}
+        self._last_used: Dict[Any, Dict[str, int]] = {}
+        self._next_explore: Dict[Any, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+
+    def select(self, key: Any, backends: Sequence[str]) -> str:
+        """Returns the backend to use for the next run."""
+        with self._lock:
+            runs = self._runs.get(key, 0) + 1
+            self._runs[key] = runs
+            histograms = self._histograms.setdefault(key, {})
+            last_used = self._last_used.setdefault(key, {})
+
+            measured = [
+                backend
+                for backend in backends
+                if backend in histograms
+                and histograms[backend].total >= self._min_samples
+            ]
+            if len(measured) == len(backends):
+                backend = min(
+                    backends, key=lambda backend: histograms[backend].percentile(0.5)
+                )
+            else:
+                backend = backends[0]
+            next_run, interval = self._next_explore.get(
+                key, (self._explore_interval, self._explore_interval)
+            )
+            if runs >= next_run:
+                if len(measured) == len(backends):
+                    interval = min(interval * 2, self._max_explore_interval)
+                self._next_explore[key] = (runs + interval, interval)
+                others = [other for other in backends if other != backend]
+                if others:
+                    backend = min(others, key=lambda other: last_used.get(other, 0))
+            last_used[backend] = runs
+            return backend
+
+    def record(self, key: Any, backend: str, seconds: float) -> None:
+        """Counts a run of the backend that took the given time."""
+        with self._lock:
+            histograms = self._histograms.setdefault(key, {})
+            if backend not in histograms:
+                histograms[backend] = LatencyHistogram()
+            else:
+                histograms[backend].add(seconds)
+
+
+# Priority classes of scheduled runs, in the order they are given slots.
+INTERACTIVE = 0  # Formatting the user waits for, like on save or a range.
+BATCH = 1  # Formatting many files, like a whole workspace.
+BACKGROUND = 2  # Formatting ahead of time, its result may never be used.
+
+
+class ScheduledRun:
+    """A slot held by a run of the scheduler.
+
+    `cancelled` is done when the run is preempted, runs that can be stopped
+    wait on it together with their result.
+    """
+
+    def __init__(self, priority: int, workspace: str):
+        self.priority = priority
+        self.workspace = workspace
+        self.cancelled: concurrent.futures.Future = concurrent.futures.Future()
+        self.started = False
+
+    def cancel(self) -> None:
+        """Asks the run to stop."""
+        if self.cancelled.set_running_or_notify_cancel():
+            self.cancelled.set_result(None)
+
+
+class PriorityScheduler:
+    """Limits the runs at the same time, giving slots by priority class.
+
+    Interactive runs never wait: one that finds no free slot cancels the
+    newest background run, which gives up its slot when it stops. Other runs
+    wait for a slot, batch runs before background runs. Within a class,
+    workspaces take turns, so one workspace with many files does not hold
+    back the others.
+    """
+
+    def __init__(self, slots: int):
+        self._slots = slots
+        self._running: List[ScheduledRun] = []
+        self._waiting: Dict[int, Dict[str, List[ScheduledRun]]] = {
+            BATCH: {},
+            BACKGROUND: {},
+        }
+        self._condition = threading.Condition()
+
+    def resize(self, slots: int) -> None:
+        """Changes the number of slots, running runs keep theirs."""
+        with self._condition:
+            self._slots = slots
+            self._start_waiting()
+
+    def _start_waiting(self) -> None:
+        started = False
+        for waiting in self._waiting.values():
+            while waiting and len(self._running) < self._slots:
+                # Dicts keep their order, the workspace goes to the back.
+                workspace = next(iter(waiting))
+                runs = waiting.pop(workspace)
+                run = runs.pop(0)
+                if runs:
+                    waiting[workspace] = runs
+                run.started = True
+                self._running.append(run)
+                started = True
+        if started:
+            self._condition.notify_all()
+
+    def _preempt(self) -> None:
+        for run in reversed(self._running):
+            if run.priority == BACKGROUND and not run.cancelled.done():
+                run.cancel()
+                return
+
+    @contextlib.contextmanager
+    def run(self, priority: int, workspace: str):
+        """Waits for a slot, and holds it until the block ends."""
+        run = ScheduledRun(priority, workspace)
+        with self._condition:
+            if priority == INTERACTIVE:
+                if len(self._running) >= self._slots:
+                    self._preempt()
+                run.started = True
+                self._running.append(run)
+            else:
+                self._waiting[priority].setdefault(workspace, []).append(run)
+                self._start_waiting()
+                self._condition.wait_for(lambda: run.started)
+        try:
+            yield run
+        finally:
+            with self._condition:
+                self._running.remove(run)
+                self._start_waiting()
 
 
 def run_path(
@@ -192,33 +817,72 @@ def run_path(
     cwd: str,
     source: str = None,
     env: Optional[Dict[str, str]] = None,
+    timeout: Optional[float] = None,
 ) -> RunResult:
-    """Runs as an executable."""
+    """Runs as an executable.
+
+    If the process does not finish within `timeout` seconds it is killed and
+    `TimeoutError` is raised.
+    """
     new_env = os.environ.copy()
     if env is not None:
         new_env.update(env)
-    if use_stdin:
-        with subprocess.Popen(
-            argv,
-            encoding="utf-8",
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            cwd=cwd,
-            env=new_env,
-        ) as process:
-            return RunResult(*process.communicate(input=source))
-    else:
-        result = subprocess.run(
-            argv,
-            encoding="utf-8",
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=False,
-            cwd=cwd,
-            env=new_env,
-        )
-        return RunResult(result.stdout, result.stderr)
+    try:
+        if use_stdin:
+            with subprocess.Popen(
+                argv,
+                encoding="utf-8",
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                stdin=subprocess.PIPE,
+                cwd=cwd,
+                env=new_env,
+            ) as process:
+                try:
+                    return RunResult(
+                        *process.communicate(input=source, timeout=timeout)
+                    )
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    raise
+        else:
+            result = subprocess.run(
+                argv,
+                encoding="utf-8",
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                check=False,
+                cwd=cwd,
+                env=new_env,
+                timeout=timeout,
+            )
+            return RunResult(result.stdout, result.stderr)
+    except subprocess.TimeoutExpired as ex:
+        raise TimeoutError(f"Timed out after {timeout}s: {argv}") from ex
+
+
+def run_with_timeout(callback: Callable[[], Any], timeout: Optional[float]) -> Any:
+    """Runs callback and returns its result, or raises `TimeoutError`.
+
+    Code running in this process cannot be killed, so on timeout the callback
+    keeps running in the background and its result is dropped.
+    """
+    if timeout is None:
+        return callback()
+
+    future = concurrent.futures.Future()
+
+    def _run():
+        try:
+            future.set_result(callback())
+        except BaseException as ex:  # pylint: disable=broad-except
+            future.set_exception(ex)
+
+    threading.Thread(target=_run, daemon=True).start()
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError as ex:
+        raise TimeoutError(f"Timed out after {timeout}s") from ex
 
 
 def run_api(
@@ -229,11 +893,8 @@ def run_api(
     source: str = None,
 ) -> RunResult:
     """Run a API."""
-    with CWD_LOCK:
-        if is_same_path(os.getcwd(), cwd):
-            return _run_api(callback, argv, use_stdin, source)
-        with change_cwd(cwd):
-            return _run_api(callback, argv, use_stdin, source)
+    with WORKING_DIRECTORY.use(cwd):
+        return _run_api(callback, argv, use_stdin, source)
 
 
 def _run_api(
@@ -246,17 +907,13 @@ def _run_api(
     str_error = CustomIO("<stderr>", encoding="utf-8")
 
     try:
-        with substitute_attr(sys, "argv", argv):
-            with redirect_io("stdout", str_output):
-                with redirect_io("stderr", str_error):
-                    if use_stdin and source is not None:
-                        str_input = CustomIO("<stdin>", encoding="utf-8", newline="\n")
-                        with redirect_io("stdin", str_input):
-                            str_input.write(source)
-                            str_input.seek(0)
-                            callback(argv, str_output, str_error, str_input)
-                    else:
-                        callback(argv, str_output, str_error)
+        if use_stdin and source is not None:
+            str_input = StringInput("<stdin>", source, encoding="utf-8")
+            with thread_stdio(str_output, str_error, str_input):
+                callback(argv, str_output, str_error, str_input)
+        else:
+            with thread_stdio(str_output, str_error):
+                callback(argv, str_output, str_error)
     except SystemExit:
         pass
 
@@ -121,6 +121,13 @@ def tests(session: nox.Session) -> None:
     session.run("pytest", "build")
 
 
+@nox.session()
+def benchmark(session: nox.Session) -> None:
+    """Compares the diff backends used to compute edits on the test data."""
+    session.install("-r", "src/test/python_tests/requirements.txt")
+    session.run("python", "src/test/python_tests/benchmark_edit_utils.py", *session.posargs)
+
+
 @nox.session()
 def lint(session: nox.Session) -> None:
     """Runs linter and formatter checks on python files."""
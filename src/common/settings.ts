@@ -16,6 +16,14 @@ export interface ISettings {
     interpreter: string[];
     importStrategy: string;
     showNotifications: string;
+    idleFormattingDelay: number;
+    saveFormattingDeadline: number;
+    editMergeGap: number;
+    maxEdits: number;
+    maxWorkers: number;
+    runnerIdleTimeout: number;
+    runnerMaxRuns: number;
+    runnerMaxMemory: number;
 }
 
 export function getExtensionSettings(namespace: string, includeInterpreter?: boolean): Promise<ISettings[]> {
@@ -109,6 +117,14 @@ export async function getWorkspaceSettings(
         interpreter: resolveVariables(interpreter, workspace),
         importStrategy: config.get<string>('importStrategy', 'useBundled'),
         showNotifications: config.get<string>('showNotifications', 'off'),
+        idleFormattingDelay: config.get<number>('idleFormattingDelay', 0),
+        saveFormattingDeadline: config.get<number>('saveFormattingDeadline', 0),
+        editMergeGap: config.get<number>('editMergeGap', 8),
+        maxEdits: config.get<number>('maxEdits', 1000),
+        maxWorkers: config.get<number>('maxWorkers', 0),
+        runnerIdleTimeout: config.get<number>('runnerIdleTimeout', 300),
+        runnerMaxRuns: config.get<number>('runnerMaxRuns', 1000),
+        runnerMaxMemory: config.get<number>('runnerMaxMemory', 512),
     };
     return workspaceSetting;
 }
@@ -137,6 +153,14 @@ export async function getGlobalSettings(namespace: string, includeInterpreter?:
         interpreter: interpreter ?? [],
         importStrategy: getGlobalValue<string>(config, 'importStrategy') ?? 'useBundled',
         showNotifications: getGlobalValue<string>(config, 'showNotifications') ?? 'off',
+        idleFormattingDelay: getGlobalValue<number>(config, 'idleFormattingDelay') ?? 0,
+        saveFormattingDeadline: getGlobalValue<number>(config, 'saveFormattingDeadline') ?? 0,
+        editMergeGap: getGlobalValue<number>(config, 'editMergeGap') ?? 8,
+        maxEdits: getGlobalValue<number>(config, 'maxEdits') ?? 1000,
+        maxWorkers: getGlobalValue<number>(config, 'maxWorkers') ?? 0,
+        runnerIdleTimeout: getGlobalValue<number>(config, 'runnerIdleTimeout') ?? 300,
+        runnerMaxRuns: getGlobalValue<number>(config, 'runnerMaxRuns') ?? 1000,
+        runnerMaxMemory: getGlobalValue<number>(config, 'runnerMaxMemory') ?? 512,
     };
     return setting;
 }
@@ -149,6 +173,14 @@ export function checkIfConfigurationChanged(e: ConfigurationChangeEvent, namespa
         `${namespace}.interpreter`,
         `${namespace}.importStrategy`,
         `${namespace}.showNotifications`,
+        `${namespace}.idleFormattingDelay`,
+        `${namespace}.saveFormattingDeadline`,
+        `${namespace}.editMergeGap`,
+        `${namespace}.maxEdits`,
+        `${namespace}.maxWorkers`,
+        `${namespace}.runnerIdleTimeout`,
+        `${namespace}.runnerMaxRuns`,
+        `${namespace}.runnerMaxMemory`,
     ];
     const changed = settings.map((s) => e.affectsConfiguration(s));
     return changed.includes(true);
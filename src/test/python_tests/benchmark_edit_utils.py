@@ -0,0 +1,105 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""
+Benchmark for the diff backends in lsp_edit_utils.
+
+Each backend diffs every unformatted and formatted pair in test_data, and the
+time, number of changes and size of the changed text are reported. Runs that
+take longer than the timeout are stopped.
+
+Usage: python src/test/python_tests/benchmark_edit_utils.py [timeout]
+"""
+
+import multiprocessing
+import os
+import pathlib
+import sys
+import time
+from typing import Optional, Tuple
+
+# From: src\test\python_tests\benchmark_edit_utils.py
+# To: bundled\tool\lsp_edit_utils.py
+UTILS_PATH = pathlib.Path(__file__).parent.parent.parent.parent / "bundled" / "tool"
+sys.path.append(os.fspath(UTILS_PATH))
+
+import lsp_edit_utils  # noqa: E402
+from lsprotocol import types as lsp  # noqa: E402
+
+TEST_DATA = pathlib.Path(__file__).parent / "test_data"
+FORMATTED_NAMES = ("sample.py", "sample.formatted", "sample_formatted.py")
+DEFAULT_TIMEOUT = 10  # seconds
+
+
+def _get_samples():
+    for sample in sorted(TEST_DATA.iterdir()):
+        unformatted = next(sample.glob("*.unformatted"), None)
+        formatted = next(
+            (sample / name for name in FORMATTED_NAMES if (sample / name).exists()),
+            None,
+        )
+        if unformatted and formatted:
+            yield (
+                sample.name,
+                unformatted.read_text(encoding="utf-8"),
+                formatted.read_text(encoding="utf-8"),
+            )
+
+
+def _run(backend: str, old_text: str, new_text: str, queue) -> None:
+    start = time.perf_counter()
+    if backend == "selected":
+        edits = lsp_edit_utils.get_text_edits(
+            old_text, new_text, lsp.PositionEncodingKind.Utf16, 3600
+        )
+        changes = len(edits)
+        changed = sum(len(edit.new_text) for edit in edits)
+    else:
+        opcodes = lsp_edit_utils.DIFF_BACKENDS[backend](old_text, new_text)
+        changes = sum(1 for opcode in opcodes if opcode[0] != "equal")
+        changed = sum(
+            new_end - new_start
+            for opcode, _, _, new_start, new_end in opcodes
+            if opcode != "equal"
+        )
+    queue.put((time.perf_counter() - start, changes, changed))
+
+
+def _measure(
+    backend: str, old_text: str, new_text: str, timeout: float
+) -> Optional[Tuple[float, int, int]]:
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_run, args=(backend, old_text, new_text, queue)
+    )
+    process.start()
+    process.join(timeout)
+    if process.is_alive():
+        process.kill()
+        process.join()
+        return None
+    return queue.get() if not queue.empty() else None
+
+
+def main(timeout: float = DEFAULT_TIMEOUT) -> None:
+    """Prints the benchmark results as a table."""
+    backends = list(lsp_edit_utils.DIFF_BACKENDS)
+    if not lsp_edit_utils.has_levenshtein():
+        backends.remove("levenshtein")
+    backends.append("selected")
+
+    print(f"{'sample':<10}{'size':>9}  {'backend':<12}{'seconds':>9}{'changes':>9}{'changed':>9}")
+    for name, old_text, new_text in _get_samples():
+        for backend in backends:
+            result = _measure(backend, old_text, new_text, timeout)
+            if result is None:
+                print(f"{name:<10}{len(old_text):>9}  {backend:<12}{'timeout':>9}")
+            else:
+                seconds, changes, changed = result
+                print(
+                    f"{name:<10}{len(old_text):>9}  {backend:<12}"
+                    f"{seconds:>9.3f}{changes:>9}{changed:>9}"
+                )
+
+
+if __name__ == "__main__":
+    main(*map(float, sys.argv[1:2]))
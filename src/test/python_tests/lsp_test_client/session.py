@@ -28,8 +28,9 @@ WINDOW_SHOW_MESSAGE = "window/showMessage"
 class LspSession(MethodDispatcher):
     """Send and Receive messages over LSP as a test LS Client."""
 
-    def __init__(self, cwd=None, script=None):
+    def __init__(self, cwd=None, script=None, env=None):
         self.cwd = cwd if cwd else os.getcwd()
+        self.env = env if env else {}
         self._thread_pool = ThreadPoolExecutor()
         self._sub = None
         self._writer = None
@@ -37,7 +38,7 @@ class LspSession(MethodDispatcher):
         self._endpoint = None
         self._notification_callbacks = {}
         self.script = (
-            script if script else (PROJECT_ROOT / "bundled" / "tool" / "lsp_server.py")
+            script if script else (PROJECT_ROOT / "bundled" / "tool" / "lsp_main.py")
         )
 
     def __enter__(self):
@@ -47,6 +48,7 @@ class LspSession(MethodDispatcher):
         """
         env = os.environ.copy()
         env["PYTHONUTF8"] = "1"
+        env.update(self.env)
         self._sub = subprocess.Popen(
             [sys.executable, str(self.script)],
             stdout=subprocess.PIPE,
@@ -145,6 +147,34 @@ class LspSession(MethodDispatcher):
         fut = self._send_request("textDocument/formatting", params=formatting_params)
         return fut.result()
 
+    def text_document_range_formatting(self, range_formatting_params):
+        """Sends text document range formatting request to LSP server."""
+        fut = self._send_request(
+            "textDocument/rangeFormatting", params=range_formatting_params
+        )
+        return fut.result()
+
+    def text_document_ranges_formatting(self, ranges_formatting_params):
+        """Sends text document ranges formatting request to LSP server."""
+        fut = self._send_request(
+            "textDocument/rangesFormatting", params=ranges_formatting_params
+        )
+        return fut.result()
+
+    def text_document_on_type_formatting(self, on_type_formatting_params):
+        """Sends text document on type formatting request to LSP server."""
+        fut = self._send_request(
+            "textDocument/onTypeFormatting", params=on_type_formatting_params
+        )
+        return fut.result()
+
+    def text_document_will_save_wait_until(self, will_save_params):
+        """Sends text document will save wait until request to LSP server."""
+        fut = self._send_request(
+            "textDocument/willSaveWaitUntil", params=will_save_params
+        )
+        return fut.result()
+
     def set_notification_callback(self, notification_name, callback):
         """Set custom LS notification handler."""
         self._notification_callbacks[notification_name] = callback
@@ -86,17 +86,28 @@ def get_initialization_options():
     return {"settings": [setting], "globalSettings": setting}
 
 
-def apply_text_edits(text: str, text_edits: List[lsp.TextEdit]) -> str:
+def apply_text_edits(
+    text: str, text_edits: List[lsp.TextEdit], position_encoding: str = "utf-32"
+) -> str:
+    """Applies the edits, with positions in code units of the position encoding."""
     if not text_edits:
         return text
 
+    lines = text.splitlines(keepends=True)
     offsets = [0]
-    for line in text.splitlines(keepends=True):
+    for line in lines:
         offsets.append(offsets[-1] + len(line))
 
+    def _offset(position: lsp.Position) -> int:
+        character = position.character
+        if position_encoding == "utf-16" and position.line < len(lines):
+            encoded = lines[position.line].encode("utf-16-le")[: character * 2]
+            character = len(encoded.decode("utf-16-le"))
+        return offsets[position.line] + character
+
     for text_edit in reversed(text_edits):
-        start_offset = offsets[text_edit.range.start.line] + text_edit.range.start.character
-        end_offset = offsets[text_edit.range.end.line] + text_edit.range.end.character
+        start_offset = _offset(text_edit.range.start)
+        end_offset = _offset(text_edit.range.end)
         text = text[:start_offset] + text_edit.new_text + text[end_offset:]
     return text
 
@@ -18,7 +18,9 @@ from lsprotocol import types as lsp
 UTILS_PATH = pathlib.Path(__file__).parent.parent.parent.parent / "bundled" / "tool"
 sys.path.append(os.fspath(UTILS_PATH))
 
-from lsp_edit_utils import get_text_edits
+from lsp_edit_utils import (DIFF_BACKENDS, LineIndex, compact_changes,
+                            get_line_ending, get_text_edits,
+                            select_diff_backend)
 
 from .lsp_test_client import constants, utils
 
@@ -156,3 +158,108 @@ def test_with_levenshtein():
 
     actual = utils.apply_text_edits(unformatted, edits)
     assert_that(actual, is_(formatted))
+
+
+@pytest.mark.parametrize("backend", list(DIFF_BACKENDS))
+def test_diff_backends(backend: str):
+    if backend == "levenshtein" and not has_levenshtein():
+        pytest.skip("Levenshtein is not installed")
+
+    FORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample8" / "sample.py"
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample8" / "sample.unformatted"
+
+    formatted = FORMATTED_TEST_FILE_PATH.read_text(encoding="utf-8")
+    unformatted = UNFORMATTED_TEST_FILE_PATH.read_text(encoding="utf-8")
+
+    actual = "".join(
+        unformatted[start:end] if opcode == "equal" else formatted[new_start:new_end]
+        for opcode, start, end, new_start, new_end in DIFF_BACKENDS[backend](
+            unformatted, formatted
+        )
+    )
+    assert_that(actual, is_(formatted))
+
+
+@pytest.mark.parametrize(
+    "size,levenshtein,expected",
+    [
+        (100, False, "difflib"),
+        (100, True, "levenshtein"),
+        (10000, False, "tokenize"),
+        (1000000, True, "patience"),
+    ],
+)
+def test_select_diff_backend(size: int, levenshtein: bool, expected: str):
+    text = "x" * (size // 2)
+    assert_that(select_diff_backend(text, text, levenshtein), is_(expected))
+
+
+@pytest.mark.parametrize(
+    "merge_gap,max_edits,expected",
+    [
+        (
+            0,
+            None,
+            [
+                ("replace", 0, 1, 0, 2),
+                ("insert", 3, 3, 4, 5),
+                ("delete", 10, 12, 12, 12),
+            ],
+        ),
+        (
+            2,
+            None,
+            [("replace", 0, 3, 0, 5), ("delete", 10, 12, 12, 12)],
+        ),
+        (0, 1, [("replace", 0, 12, 0, 12)]),
+    ],
+)
+def test_compact_changes(merge_gap: int, max_edits: int, expected: List[tuple]):
+    changes = [
+        ("replace", 0, 1, 0, 2),
+        ("insert", 3, 3, 4, 5),
+        ("delete", 10, 12, 12, 12),
+    ]
+    assert_that(compact_changes(changes, merge_gap, max_edits), is_(expected))
+
+
+@pytest.mark.parametrize(
+    "text,start,end,new_text,expected",
+    [
+        ("a\nb\nc\n", (1, 0), (1, 1), "x\ny", "a\nx\ny\nc\n"),
+        ("a\nb\nc\n", (0, 1), (2, 0), "", "ac\n"),
+        ("a\r\nb\r", (1, 1), (1, 2), "\r\n😀", "a\r\nb\r\n😀"),
+        ("a\r", (1, 0), (1, 0), "\nb", "a\r\nb"),
+        ("", (0, 0), (0, 0), "é", "é"),
+    ],
+)
+def test_line_index_updated(text, start, end, new_text, expected):
+    actual = LineIndex(text).updated(start, end, new_text)
+    expected_index = LineIndex(expected)
+
+    assert_that(actual.lines, is_(expected_index.lines))
+    assert_that(actual.size, is_(expected_index.size))
+    assert_that(actual.line_starts, is_(expected_index.line_starts))
+    assert_that(
+        [
+            actual.to_code_units(line, len(text), lsp.PositionEncodingKind.Utf16)
+            for line, text in enumerate(actual.lines)
+        ],
+        is_(
+            [
+                expected_index.to_code_units(
+                    line, len(text), lsp.PositionEncodingKind.Utf16
+                )
+                for line, text in enumerate(expected_index.lines)
+            ]
+        ),
+    )
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [("", None), ("a", "\n"), ("a\r\nb\n", "\r\n"), ("a\nb\r\n", "\n")],
+)
+def test_get_line_ending(text, expected):
+    assert_that(get_line_ending(text), is_(expected))
+    assert_that(LineIndex(text).line_ending, is_(expected))
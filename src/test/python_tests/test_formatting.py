@@ -5,9 +5,11 @@ Test for formatting over LSP.
 """ 
 import copy
 import pathlib
+import time
+from typing import List, Optional
 
 import pytest
-from hamcrest import assert_that, is_
+from hamcrest import assert_that, is_, less_than_or_equal_to
 
 from .lsp_test_client import constants, defaults, session, utils
 
@@ -302,3 +304,385 @@ def test_formatting_file_with_excluded_with_multiple_globs():
     expected = None
     assert_that(actual, is_(expected))
 
+
+def test_ranges_formatting():
+    """Test formatting multiple ranges of a python file in a single request."""
+    FORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample9" / "sample.formatted"
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample9" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text(encoding="utf-8")
+    actual = []
+    with utils.python_file(contents, UNFORMATTED_TEST_FILE_PATH.parent) as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.initialize()
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            actual = ls_session.text_document_ranges_formatting(
+                {
+                    "textDocument": {"uri": uri},
+                    "ranges": [
+                        {
+                            "start": {"line": 0, "character": 0},
+                            "end": {"line": 0, "character": 10},
+                        },
+                        {
+                            "start": {"line": 2, "character": 0},
+                            "end": {"line": 3, "character": 0},
+                        },
+                        {
+                            "start": {"line": 3, "character": 0},
+                            "end": {"line": 3, "character": 5},
+                        },
+                    ],
+                    # `options` is not used by autopep8
+                    "options": {"tabSize": 4, "insertSpaces": True},
+                }
+            )
+
+    expected_text = FORMATTED_TEST_FILE_PATH.read_text(encoding="utf-8")
+    actual_text = utils.apply_text_edits(contents, utils.destructure_text_edits(actual))
+    assert_that(actual_text, is_(expected_text))
+
+
+def test_range_formatting_whole_lines():
+    """Test a range ending at the start of a line does not format that line."""
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample9" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text(encoding="utf-8")
+    actual = []
+    with utils.python_file(contents, UNFORMATTED_TEST_FILE_PATH.parent) as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.initialize()
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            actual = ls_session.text_document_range_formatting(
+                {
+                    "textDocument": {"uri": uri},
+                    "range": {
+                        "start": {"line": 0, "character": 0},
+                        "end": {"line": 2, "character": 0},
+                    },
+                    # `options` is not used by autopep8
+                    "options": {"tabSize": 4, "insertSpaces": True},
+                }
+            )
+
+    expected_text = "import sys\nprint(sys.executable)\nx = 1\ny=[1,2]\nz=(3,4)\n"
+    actual_text = utils.apply_text_edits(contents, utils.destructure_text_edits(actual))
+    assert_that(actual_text, is_(expected_text))
+
+
+def test_on_type_formatting():
+    """Test formatting the statement completed by typing a new line."""
+    contents = "import sys\n\n\ndef main(a,b) :\n    x=foo( a,\nb )\n    \n"
+    expected_text = "import sys\n\n\ndef main(a,b) :\n    x = foo(a,\n            b)\n    \n"
+
+    actual = []
+    with utils.python_file(contents, constants.TEST_DATA / "sample1") as pf:
+        uri = utils.as_uri(str(pf))
+
+        # The time budget is for typing, not for a loaded test machine.
+        with session.LspSession(
+            env={"LS_ON_TYPE_FORMATTING_TIMEOUT": "60"}
+        ) as ls_session:
+            ls_session.initialize()
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            actual = ls_session.text_document_on_type_formatting(
+                {
+                    "textDocument": {"uri": uri},
+                    "position": {"line": 6, "character": 4},
+                    "ch": "\n",
+                    # `options` is not used by autopep8
+                    "options": {"tabSize": 4, "insertSpaces": True},
+                }
+            )
+
+    actual_text = utils.apply_text_edits(contents, utils.destructure_text_edits(actual))
+    assert_that(actual_text, is_(expected_text))
+
+
+def test_idle_formatting():
+    """Test formatting re-uses the result of formatting after an edit."""
+    FORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.py"
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text(encoding="utf-8")
+    runs = []
+
+    def check_for_formatter_run(params):
+        if params["message"].endswith(" -"):
+            runs.append(params["message"])
+
+    actual = []
+    with utils.python_file("", UNFORMATTED_TEST_FILE_PATH.parent) as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.set_notification_callback(
+                session.WINDOW_LOG_MESSAGE, check_for_formatter_run
+            )
+
+            init_args = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+            init_options = init_args["initializationOptions"]
+            init_options["settings"][0]["idleFormattingDelay"] = 50
+            ls_session.initialize(init_args)
+
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": "",
+                    }
+                }
+            )
+            ls_session.notify_did_change(
+                {
+                    "textDocument": {"uri": uri, "version": 2},
+                    "contentChanges": [{"text": contents}],
+                }
+            )
+            time.sleep(2)
+            runs_before_formatting = len(runs)
+
+            actual = ls_session.text_document_formatting(
+                {
+                    "textDocument": {"uri": uri},
+                    # `options` is not used by autopep8
+                    "options": {"tabSize": 4, "insertSpaces": True},
+                }
+            )
+
+    expected_text = FORMATTED_TEST_FILE_PATH.read_text(encoding="utf-8")
+    actual_text = utils.apply_text_edits(contents, utils.destructure_text_edits(actual))
+    assert_that(actual_text, is_(expected_text))
+    assert_that(runs_before_formatting, is_(1))
+    assert_that(len(runs), is_(1))
+
+
+@pytest.mark.parametrize("deadline, formatted", [(10000, True), (1, False)])
+def test_will_save_wait_until(deadline: int, formatted: bool):
+    """Test formatting on save is skipped when the deadline is exceeded."""
+    FORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.py"
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text(encoding="utf-8")
+    actual = []
+    with utils.python_file(contents, UNFORMATTED_TEST_FILE_PATH.parent) as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            init_args = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+            init_options = init_args["initializationOptions"]
+            init_options["settings"][0]["saveFormattingDeadline"] = deadline
+            ls_session.initialize(init_args)
+
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            actual = ls_session.text_document_will_save_wait_until(
+                {
+                    "textDocument": {"uri": uri},
+                    # Manual save
+                    "reason": 1,
+                }
+            )
+
+    if formatted:
+        expected_text = FORMATTED_TEST_FILE_PATH.read_text(encoding="utf-8")
+        actual_text = utils.apply_text_edits(
+            contents, utils.destructure_text_edits(actual)
+        )
+        assert_that(actual_text, is_(expected_text))
+    else:
+        assert_that(actual, is_(None))
+
+
+def test_formatting_max_edits():
+    """Test nearby edits are merged to stay within the edit limit."""
+    FORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample6" / "sample.py"
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample6" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text(encoding="utf-8")
+    actual = []
+    with utils.python_file(contents, UNFORMATTED_TEST_FILE_PATH.parent) as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            init_args = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+            init_options = init_args["initializationOptions"]
+            init_options["settings"][0]["editMergeGap"] = 0
+            init_options["settings"][0]["maxEdits"] = 10
+            ls_session.initialize(init_args)
+
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            actual = ls_session.text_document_formatting(
+                {
+                    "textDocument": {"uri": uri},
+                    # `options` is not used by autopep8
+                    "options": {"tabSize": 4, "insertSpaces": True},
+                }
+            )
+
+    expected_text = FORMATTED_TEST_FILE_PATH.read_text(encoding="utf-8")
+    actual_text = utils.apply_text_edits(contents, utils.destructure_text_edits(actual))
+    assert_that(actual_text, is_(expected_text))
+    assert_that(len(actual), less_than_or_equal_to(10))
+
+
+@pytest.mark.parametrize(
+    "encodings", [["utf-8", "utf-16", "utf-32"], ["utf-16"], None]
+)
+def test_position_encoding(encodings: Optional[List[str]]):
+    """Test UTF-16 positions are used, also for changes after astral characters."""
+    FORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample10" / "sample.py"
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample10" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text(encoding="utf-8")
+    actual = []
+    capabilities = []
+    with utils.python_file(contents, UNFORMATTED_TEST_FILE_PATH.parent) as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            init_args = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+            if encodings is not None:
+                init_args["capabilities"]["general"] = {"positionEncodings": encodings}
+            ls_session.initialize(init_args, capabilities.append)
+
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents.replace("print", "prXnt"),
+                    }
+                }
+            )
+            # Replaces "X", which is after the two UTF-16 code units of "😀".
+            ls_session.notify_did_change(
+                {
+                    "textDocument": {"uri": uri, "version": 2},
+                    "contentChanges": [
+                        {
+                            "range": {
+                                "start": {"line": 0, "character": 11},
+                                "end": {"line": 0, "character": 12},
+                            },
+                            "text": "i",
+                        }
+                    ],
+                }
+            )
+            actual = ls_session.text_document_formatting(
+                {
+                    "textDocument": {"uri": uri},
+                    # `options` is not used by autopep8
+                    "options": {"tabSize": 4, "insertSpaces": True},
+                }
+            )
+
+    assert_that(capabilities[0]["capabilities"]["positionEncoding"], is_("utf-16"))
+    expected_text = FORMATTED_TEST_FILE_PATH.read_text(encoding="utf-8")
+    actual_text = utils.apply_text_edits(
+        contents, utils.destructure_text_edits(actual), "utf-16"
+    )
+    assert_that(actual_text, is_(expected_text))
+
+
+def test_formatting_after_incremental_change():
+    """Test formatting uses the document as changed by incremental updates."""
+    FORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.py"
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text(encoding="utf-8")
+    actual = []
+    with utils.python_file(contents, UNFORMATTED_TEST_FILE_PATH.parent) as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.initialize()
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            params = {
+                "textDocument": {"uri": uri},
+                # `options` is not used by autopep8
+                "options": {"tabSize": 4, "insertSpaces": True},
+            }
+            ls_session.text_document_formatting(params)
+            ls_session.notify_did_change(
+                {
+                    "textDocument": {"uri": uri, "version": 2},
+                    "contentChanges": [
+                        {
+                            "range": {
+                                "start": {"line": 0, "character": 0},
+                                "end": {"line": 0, "character": 0},
+                            },
+                            "text": "x=1\n",
+                        }
+                    ],
+                }
+            )
+            actual = ls_session.text_document_formatting(params)
+
+    expected_text = "x = 1\n" + FORMATTED_TEST_FILE_PATH.read_text(encoding="utf-8")
+    actual_text = utils.apply_text_edits(
+        "x=1\n" + contents, utils.destructure_text_edits(actual)
+    )
+    assert_that(actual_text, is_(expected_text))
@@ -0,0 +1,452 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""
+Test for JSON-RPC transport used with the runner.
+"""
+
+import io
+import os
+import pathlib
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import CancelledError
+
+import pytest
+from hamcrest import assert_that, is_
+
+# From: src\test\python_tests\test_jsonrpc.py
+# To: bundled\tool\lsp_jsonrpc.py
+UTILS_PATH = pathlib.Path(__file__).parent.parent.parent.parent / "bundled" / "tool"
+sys.path.append(os.fspath(UTILS_PATH))
+
+import lsp_runner  # noqa: E402
+from lsp_jsonrpc import (COMPACT_BUFFER_MAX_SIZE, COMPACT_FRAMING,
+                         CONTENT_LENGTH_FRAMING, RUNNER_SCRIPT,
+                         USE_FORK_SERVER, JsonReader, JsonRpc, JsonWriter,
+                         ProcessManager, ProcessMonitor, RpcRunJob,
+                         StreamClosedException, forget_document_changes,
+                         get_document_changes, get_or_start_json_rpc,
+                         get_runner_key, read_shared_text,
+                         record_document_changes, remove_shared_text,
+                         run_many_over_json_rpc, run_over_json_rpc,
+                         shutdown_json_rpc, write_shared_text)
+
+MESSAGES = [
+    {"id": "1", "method": "exit"},
+    {"id": "2", "method": "run", "argv": ["-"], "source": "s = 'é😀'\r\n\"\\\n"},
+    {"id": "3", "error": "", "result": ""},
+]
+
+
+@pytest.mark.parametrize("framing", [CONTENT_LENGTH_FRAMING, COMPACT_FRAMING])
+def test_framing(framing):
+    """Test messages are read back the same with each framing."""
+    stream = io.BytesIO()
+    writer = JsonWriter(stream)
+    for message in MESSAGES:
+        writer.write(message, framing)
+
+    reader = JsonReader(io.BufferedReader(io.BytesIO(stream.getvalue())))
+    for message in MESSAGES:
+        assert_that(reader.read(), is_(message))
+        assert_that(reader.framing, is_(framing))
+    with pytest.raises(EOFError):
+        reader.read()
+
+
+def test_compact_buffer_size():
+    """Test the buffer for compact frames does not keep the size of large ones."""
+    messages = [
+        {"id": "1", "result": "x" * (2 * COMPACT_BUFFER_MAX_SIZE)},
+        {"id": "2", "result": "y" * 100},
+    ]
+    stream = io.BytesIO()
+    writer = JsonWriter(stream)
+    for message in messages:
+        writer.write(message, COMPACT_FRAMING)
+
+    reader = JsonReader(io.BufferedReader(io.BytesIO(stream.getvalue())))
+    for message in messages:
+        assert_that(reader.read(), is_(message))
+        buffer = reader._buffer  # pylint: disable=protected-access
+        assert_that(len(buffer) <= COMPACT_BUFFER_MAX_SIZE, is_(True))
+
+
+def test_reply_framing():
+    """Test replies are sent with the framing of the received message."""
+    stream = io.BytesIO()
+    JsonWriter(stream).write(MESSAGES[1], COMPACT_FRAMING)
+    output = io.BytesIO()
+    rpc = JsonRpc(io.BufferedReader(io.BytesIO(stream.getvalue())), output)
+
+    assert_that(rpc.receive_data(), is_(MESSAGES[1]))
+    rpc.send_data(MESSAGES[2])
+
+    reader = JsonReader(io.BufferedReader(io.BytesIO(output.getvalue())))
+    assert_that(reader.read(), is_(MESSAGES[2]))
+    assert_that(reader.framing, is_(COMPACT_FRAMING))
+
+
+def test_out_of_order_responses():
+    """Test responses are matched to their requests by id."""
+    read_fd, write_fd = os.pipe()
+    with open(read_fd, "rb") as readable, open(write_fd, "wb") as writable:
+        rpc = JsonRpc(readable, io.BytesIO(), COMPACT_FRAMING)
+        futures = [rpc.send_request({"id": str(i), "method": "run"}) for i in range(3)]
+
+        writer = JsonWriter(writable)
+        for i in (2, 0, 1):
+            writer.write({"id": str(i), "result": f"result {i}"}, COMPACT_FRAMING)
+        for i, future in enumerate(futures):
+            assert_that(future.result(10)["result"], is_(f"result {i}"))
+
+        pending = rpc.send_request({"id": "3", "method": "run"})
+        writable.close()
+        with pytest.raises(EOFError):
+            pending.result(10)
+
+
+def test_stream_responses():
+    """Test each response to a stream request is queued until the last one."""
+    read_fd, write_fd = os.pipe()
+    with open(read_fd, "rb") as readable, open(write_fd, "wb") as writable:
+        rpc = JsonRpc(readable, io.BytesIO())
+        responses = rpc.send_stream_request({"id": "1", "method": "runMany"})
+        future = rpc.send_request({"id": "2", "method": "run"})
+
+        writer = JsonWriter(writable)
+        writer.write({"id": "1", "job": 1, "result": "b"})
+        writer.write({"id": "2", "result": "c"})
+        writer.write({"id": "1", "job": 0, "result": "a"})
+        writer.write({"id": "1", "done": True})
+
+        assert_that(future.result(10)["result"], is_("c"))
+        assert_that(responses.get(timeout=10)["result"], is_("b"))
+        assert_that(responses.get(timeout=10)["result"], is_("a"))
+        assert_that(responses.get(timeout=10)["done"], is_(True))
+
+
+def test_discarded_shared_result():
+    """Test the shared result of a discarded request is removed."""
+    read_fd, write_fd = os.pipe()
+    with open(read_fd, "rb") as readable, open(write_fd, "wb") as writable:
+        rpc = JsonRpc(readable, io.BytesIO())
+        rpc.send_request({"id": "1", "method": "run"})
+        rpc.discard_request("1")
+        future = rpc.send_request({"id": "2", "method": "run"})
+
+        handle = write_shared_text("x = 1\n")
+        writer = JsonWriter(writable)
+        writer.write({"id": "1", "sharedResult": handle})
+        writer.write({"id": "2", "result": ""})
+
+        future.result(10)
+        assert_that(os.path.exists(handle["path"]), is_(False))
+
+
+def test_shared_text():
+    """Test text passed through a shared file."""
+    text = "s = 'é😀'\r\n" * 1000
+    handle = write_shared_text(text)
+    try:
+        assert_that(read_shared_text(handle), is_(text))
+    finally:
+        remove_shared_text(handle)
+    assert_that(os.path.exists(handle["path"]), is_(False))
+
+
+def test_document_changes():
+    """Test changes are returned only when all versions in between are recorded."""
+    uri = "file:///test_document_changes.py"
+    record_document_changes(uri, 1, 2, [[0, 0, 0, 0, "a"]], 100)
+    record_document_changes(uri, 2, 4, [[0, 0, 0, 1, "b"], ["c"]], 100)
+    try:
+        assert_that(get_document_changes(uri, 4, 4), is_([]))
+        assert_that(get_document_changes(uri, 2, 4), is_([[0, 0, 0, 1, "b"], ["c"]]))
+        assert_that(
+            get_document_changes(uri, 1, 4),
+            is_([[0, 0, 0, 0, "a"], [0, 0, 0, 1, "b"], ["c"]]),
+        )
+        assert_that(get_document_changes(uri, 1, 3), is_(None))
+        assert_that(get_document_changes(uri, 0, 4), is_(None))
+
+        # A gap in the versions drops the older changes.
+        record_document_changes(uri, 6, 7, [["d"]], 100)
+        assert_that(get_document_changes(uri, 1, 7), is_(None))
+        assert_that(get_document_changes(uri, 6, 7), is_([["d"]]))
+
+        # Changes are dropped once their text is as large as the document.
+        record_document_changes(uri, 7, 8, [[0, 0, 0, 1, "e" * 50]], 100)
+        record_document_changes(uri, 8, 9, [[0, 0, 0, 1, "f" * 49]], 100)
+        assert_that(get_document_changes(uri, 6, 9), is_(None))
+        assert_that(len(get_document_changes(uri, 7, 9)), is_(2))
+        record_document_changes(uri, 9, 10, [["g" * 100]], 100)
+        assert_that(get_document_changes(uri, 9, 10), is_(None))
+    finally:
+        forget_document_changes(uri)
+    assert_that(get_document_changes(uri, 7, 9), is_(None))
+
+
+@pytest.mark.parametrize("use_pidfd", [True, False])
+def test_process_monitor(monkeypatch, use_pidfd):
+    """Test one monitor calls back for each process that exits."""
+    if not use_pidfd:
+        monkeypatch.delattr(os, "pidfd_open", raising=False)
+    elif not hasattr(os, "pidfd_open"):
+        pytest.skip("pidfds are not supported")
+    monitor = ProcessMonitor(poll_interval=0.05)
+    exited = []
+    procs = [
+        subprocess.Popen([sys.executable, "-c", f"import time; time.sleep({i / 10})"])
+        for i in range(3)
+    ]
+    events = [threading.Event() for _ in procs]
+    for i, (proc, event) in enumerate(zip(procs, events)):
+        monitor.watch(proc, lambda i=i, event=event: (exited.append(i), event.set()))
+
+    for event in events:
+        assert_that(event.wait(10), is_(True))
+    assert_that(sorted(exited), is_([0, 1, 2]))
+
+
+def test_shared_runners(tmp_path):
+    """Test workspaces with the same key share a runner until none uses it."""
+    manager = ProcessManager()
+    args = [sys.executable, "-c", "import sys; sys.stdin.read()"]
+    venv = get_runner_key(["python"], {"LS_IMPORT_STRATEGY": "fromEnvironment"})
+    bundled = get_runner_key(["python"], {"LS_IMPORT_STRATEGY": "useBundled"})
+    try:
+        shared = manager.get_or_start("a", venv, args, os.fspath(tmp_path))
+        assert_that(
+            manager.get_or_start("b", venv, args, os.fspath(tmp_path)), is_(shared)
+        )
+
+        manager.get_or_start("a", bundled, args, os.fspath(tmp_path))
+        assert_that(manager.get_json_rpc(venv), is_(shared))
+
+        manager.get_or_start("b", bundled, args, os.fspath(tmp_path))
+        with pytest.raises(StreamClosedException):
+            manager.get_json_rpc(venv)
+    finally:
+        manager.stop_process("a")
+
+
+def test_shared_runner_stopped(tmp_path):
+    """Test a stopped runner is killed only once other workspaces are done with it."""
+    manager = ProcessManager()
+    key = get_runner_key(["python"], {})
+    args = [sys.executable, "-c", "import sys; sys.stdin.read()"]
+    try:
+        shared = manager.get_or_start("a", key, args, os.fspath(tmp_path))
+        manager.get_or_start("b", key, args, os.fspath(tmp_path))
+        shared.send_request({"id": "1", "method": "run"})
+        proc = manager._processes[key]  # pylint: disable=protected-access
+
+        manager.stop_process("a")
+        with pytest.raises(StreamClosedException):
+            manager.get_json_rpc(key)
+        assert_that(proc.poll(), is_(None))
+
+        shared.discard_request("1")
+        manager.get_or_start("b", key, args, os.fspath(tmp_path))
+        proc.wait(30)
+    finally:
+        manager.stop_process("a")
+        manager.stop_process("b")
+
+
+def test_retiring_runner_closes_document(tmp_path):
+    """Test a closed document is dropped by runners that are being stopped."""
+    manager = ProcessManager()
+    key = get_runner_key(["python"], {})
+    args = [sys.executable, "-c", "import sys; sys.stdin.read()"]
+    try:
+        shared = manager.get_or_start("a", key, args, os.fspath(tmp_path))
+        manager.get_or_start("b", key, args, os.fspath(tmp_path))
+        shared.send_request({"id": "1", "method": "run"})
+        shared.documents["file:///a.py"] = 1
+        proc = manager._processes[key]  # pylint: disable=protected-access
+
+        manager.stop_process("a")
+        assert_that(manager.has_document("file:///a.py"), is_(True))
+        manager.close_document("file:///a.py")
+        assert_that(manager.has_document("file:///a.py"), is_(False))
+
+        shared.discard_request("1")
+        manager.get_or_start("b", key, args, os.fspath(tmp_path))
+        proc.wait(30)
+    finally:
+        manager.stop_process("a")
+        manager.stop_process("b")
+
+
+def test_exited_runner_forgotten(tmp_path):
+    """Test a runner that exits right away is not kept, however soon it exits."""
+    manager = ProcessManager()
+    key = get_runner_key(["python"], {})
+    args = [sys.executable, "-c", "pass"]
+    try:
+        manager.get_or_start("a", key, args, os.fspath(tmp_path))
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                manager.get_json_rpc(key)
+            except StreamClosedException:
+                break
+            assert_that(time.monotonic() < deadline, is_(True))
+            time.sleep(0.05)
+    finally:
+        manager.stop_process("a")
+
+
+def _start_runner(manager, tmp_path):
+    env = {"LS_IMPORT_STRATEGY": "useBundled"}
+    args = [sys.executable, RUNNER_SCRIPT]
+    key = get_runner_key([sys.executable], env)
+    return manager.get_or_start("a", key, args, os.fspath(tmp_path), env), key
+
+
+def test_runner_replaced(tmp_path):
+    """Test a runner is replaced after its runs, once the new one answers."""
+    manager = ProcessManager(idle_timeout=0, max_runs=2, max_memory=0)
+    try:
+        first, _ = _start_runner(manager, tmp_path)
+        assert_that(_start_runner(manager, tmp_path)[0], is_(first))
+
+        # Runs keep going to the first runner until the new one answers.
+        deadline = time.monotonic() + 30
+        replaced = first
+        while replaced is first:
+            assert_that(time.monotonic() < deadline, is_(True))
+            time.sleep(0.05)
+            replaced = _start_runner(manager, tmp_path)[0]
+
+        # The first runner exits, as it has no pending runs. Depending on how
+        # far it got, the request fails when sent or while waiting.
+        with pytest.raises((EOFError, OSError, ValueError, StreamClosedException)):
+            first.send_request({"id": "1", "method": "ping"}).result(30)
+        response = replaced.send_request({"id": "2", "method": "ping"}).result(30)
+        assert_that(response["id"], is_("2"))
+    finally:
+        manager.stop_process("a")
+
+
+def test_idle_runner_stopped(tmp_path):
+    """Test a runner exits after it is not used for the idle timeout."""
+    manager = ProcessManager(idle_timeout=0.2, max_runs=0, max_memory=0)
+    try:
+        _, key = _start_runner(manager, tmp_path)
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                manager.get_json_rpc(key)
+            except StreamClosedException:
+                break
+            assert_that(time.monotonic() < deadline, is_(True))
+            time.sleep(0.05)
+    finally:
+        manager.stop_process("a")
+
+
+def test_missing_shared_source(tmp_path):
+    """Test a run whose shared source is gone is answered as a stale document."""
+    manager = ProcessManager()
+    try:
+        rpc, _ = _start_runner(manager, tmp_path)
+        handle = write_shared_text("x = 1\n")
+        remove_shared_text(handle)
+        msg = {
+            "id": "1",
+            "method": "run",
+            "module": "autopep8",
+            "argv": ["-"],
+            "useStdin": True,
+            "cwd": os.fspath(tmp_path),
+            "uri": "file:///a.py",
+            "version": 1,
+            "sharedSource": handle,
+        }
+        response = rpc.send_request(msg).result(30)
+        assert_that(response.get("staleDocument", False), is_(True))
+
+        # The runner keeps serving requests.
+        response = rpc.send_request({"id": "2", "method": "ping"}).result(30)
+        assert_that(response["id"], is_("2"))
+    finally:
+        manager.stop_process("a")
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Fork is not supported")
+def test_fork_server_cancel(monkeypatch):
+    """Test cancelled calls are dropped before they start, or killed."""
+    # The zygote detaches from the streams of the runner, pytest replaced them.
+    monkeypatch.setattr(lsp_runner.utils, "detach_stdio", lambda: None)
+    server = lsp_runner.ForkServer(1)
+    try:
+        running = server.submit("1", time.sleep, 0.5)
+        queued = server.submit("2", time.sleep, 0)
+        server.cancel("2")
+        with pytest.raises(CancelledError):
+            queued.result(30)
+        assert_that(running.result(30), is_(None))
+
+        killed = server.submit("3", time.sleep, 60)
+        time.sleep(0.1)
+        server.cancel("3")
+        with pytest.raises((ChildProcessError, CancelledError)):
+            killed.result(30)
+    finally:
+        server.shutdown()
+
+
+def test_runner_document_cache(monkeypatch):
+    """Test the runner applies changes to its cached document and keeps one copy."""
+    monkeypatch.setattr(lsp_runner, "DOCUMENTS", {})
+    uri = "file:///a.py"
+    source = lsp_runner.get_document_source(
+        {"uri": uri, "version": 1}, "x=1\ny=2\n"
+    )
+    assert_that(source, is_("x=1\ny=2\n"))
+
+    msg = {"uri": uri, "version": 2, "baseVersion": 1, "size": 9}
+    msg["changes"] = [[1, 2, 1, 3, "20"]]
+    assert_that(lsp_runner.get_document_source(msg, None), is_("x=1\ny=20\n"))
+    _, document = lsp_runner.DOCUMENTS[uri]
+    assert_that(document.lines, is_(["x=1\n", "y=20\n"]))
+
+    msg = {"uri": uri, "version": 3, "baseVersion": 1, "size": 9, "changes": []}
+    assert_that(lsp_runner.get_document_source(msg, None), is_(None))
+
+
+@pytest.mark.skipif(not USE_FORK_SERVER, reason="Runs are cancelled by the fork server")
+def test_run_many_timeout(tmp_path):
+    """Test only the batch that timed out is stopped, not its runner."""
+    cwd = os.fspath(tmp_path)
+    (tmp_path / "slow.py").write_text("import time\ntime.sleep(60)\n")
+    jobs = [RpcRunJob(["slow"], cwd) for _ in range(2)]
+    try:
+        rpc = get_or_start_json_rpc("a", [sys.executable], cwd)
+        with pytest.raises(TimeoutError):
+            for _ in run_many_over_json_rpc(
+                "a", [sys.executable], "slow", jobs, False, cwd, timeout=0.5
+            ):
+                pass
+        assert_that(rpc.has_pending(), is_(False))
+        assert_that(get_or_start_json_rpc("a", [sys.executable], cwd), is_(rpc))
+
+        # The runner has its workers back for other runs.
+        result = run_over_json_rpc(
+            "a",
+            [sys.executable],
+            "autopep8",
+            ["autopep8", "-"],
+            True,
+            cwd,
+            "x=1\n",
+            timeout=30,
+        )
+        assert_that(result.stdout, is_("x = 1\n"))
+    finally:
+        shutdown_json_rpc()
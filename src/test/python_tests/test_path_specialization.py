@@ -206,3 +206,46 @@ def test_interpreter():
             actual = argv_callback_object.check_result()
 
     assert_that(actual, is_(False))
+
+
+def test_import_strategy_from_environment():
+    """Test formatting with autopep8 from the environment runs the default path."""
+    init_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+    init_params["initializationOptions"]["settings"][0][
+        "importStrategy"
+    ] = "fromEnvironment"
+
+    messages = []
+    contents = TEST_FILE.read_text()
+
+    with utils.python_file(contents, TEST_FILE.parent) as file:
+        uri = utils.as_uri(str(file))
+
+        with session.LspSession() as ls_session:
+            ls_session.set_notification_callback(
+                session.WINDOW_LOG_MESSAGE,
+                lambda params: messages.append(params["message"]),
+            )
+
+            ls_session.initialize(init_params)
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+
+            ls_session.text_document_formatting(
+                {
+                    "textDocument": {"uri": uri},
+                    "options": {"tabSize": 4, "insertSpaces": True},
+                }
+            )
+
+    # The run is logged by the backend used, a subprocess logs "CWD Server".
+    runs = [messages[i + 1] for i, m in enumerate(messages) if m.endswith(" -")]
+    assert_that([run.split(":")[0] for run in runs], is_(["CWD Server"]))
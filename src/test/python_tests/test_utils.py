@@ -0,0 +1,186 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""
+Test for running the tool in the same process with lsp_utils.
+"""
+
+import os
+import pathlib
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from hamcrest import assert_that, is_
+
+# From: src\test\python_tests\test_utils.py
+# To: bundled\tool\lsp_utils.py
+UTILS_PATH = pathlib.Path(__file__).parent.parent.parent.parent / "bundled" / "tool"
+sys.path.append(os.fspath(UTILS_PATH))
+
+import lsp_utils  # noqa: E402
+
+SOURCE = "x=1;y = 2\nif  x :\n  pass\n"
+FORMATTED = "x = 1\ny = 2\nif x:\n    pass\n"
+
+
+def test_run_module_repeated(tmp_path):
+    """Test runs with other arguments do not change the result of later runs."""
+    import autopep8  # pylint: disable=import-outside-toplevel
+
+    def _run(*args):
+        return lsp_utils.run_module(
+            "autopep8", ["autopep8", *args, "-"], True, os.fspath(tmp_path), SOURCE
+        )
+
+    first = _run()
+    checks = {
+        kind: len(checks)
+        for kind, checks in autopep8.pycodestyle._checks.items()  # pylint: disable=protected-access
+    }
+    ignored = _run("--ignore=E231,E701,E702")
+    selected = _run("--select=E1")
+
+    assert_that(first.stdout, is_(FORMATTED))
+    assert_that(ignored.stdout, is_("x = 1;y = 2\nif x:\n    pass\n"))
+    assert_that(selected.stdout, is_("x=1;y = 2\nif  x :\n    pass\n"))
+    assert_that(_run().stdout, is_(FORMATTED))
+    assert_that(
+        {
+            kind: len(checks)
+            for kind, checks in autopep8.pycodestyle._checks.items()  # pylint: disable=protected-access
+        },
+        is_(checks),
+    )
+
+
+def test_run_module_threads(tmp_path):
+    """Test runs on several threads get their own arguments and output."""
+    cases = [
+        ([], "x = 1\ny = 2\nif x:\n    pass\n"),
+        (["--ignore=E231,E701,E702"], "x = 1;y = 2\nif x:\n    pass\n"),
+        (["--select=E1"], "x=1;y = 2\nif  x :\n    pass\n"),
+    ] * 4
+
+    def _run(args):
+        return lsp_utils.run_module(
+            "autopep8", ["autopep8", *args, "-"], True, os.fspath(tmp_path), SOURCE
+        )
+
+    with ThreadPoolExecutor(len(cases)) as executor:
+        results = list(executor.map(_run, [args for args, _ in cases]))
+
+    assert_that([result.stdout for result in results], is_([out for _, out in cases]))
+    assert_that([result.stderr for result in results], is_([""] * len(cases)))
+
+
+def test_run_module_exit(tmp_path, capsys):
+    """Test the process state is unchanged after a run that exits."""
+    argv = sys.argv[:]
+    cwd = os.getcwd()
+    result = lsp_utils.run_module(
+        "autopep8", ["autopep8", "--no-such-option", "-"], True, os.fspath(tmp_path), ""
+    )
+
+    assert_that("--no-such-option" in result.stderr, is_(True))
+    assert_that(sys.argv, is_(argv))
+    assert_that(os.getcwd(), is_(cwd))
+    print("after the run")
+    assert_that(capsys.readouterr().out, is_("after the run\n"))
+
+
+def test_tool_process_pool(tmp_path):
+    """Test runs in worker processes match runs in this process."""
+    pool = lsp_utils.ToolProcessPool("autopep8", 2)
+    try:
+        for args in ([], ["--select=E1"], []):
+            argv = ["autopep8", *args, "-"]
+            assert_that(
+                pool.run_module(argv, True, os.fspath(tmp_path), SOURCE, 60).stdout,
+                is_(
+                    lsp_utils.run_module(
+                        "autopep8", argv, True, os.fspath(tmp_path), SOURCE
+                    ).stdout
+                ),
+            )
+    finally:
+        pool.shutdown()
+
+
+def test_backend_selector():
+    """Test the fastest backend is used once all are measured."""
+    latencies = {"slow": 0.05, "fast": 0.005, "slower": 0.2}
+    selector = lsp_utils.BackendSelector(min_samples=3, explore_interval=4)
+    used = []
+    for _ in range(200):
+        backend = selector.select("key", ("slow", "fast", "slower"))
+        selector.record("key", backend, latencies[backend])
+        used.append(backend)
+
+    # The first backend is used until the others are measured.
+    assert_that(used[:3], is_(["slow"] * 3))
+    # Once all are measured, other backends are tried less and less often.
+    explored = [run for run, backend in enumerate(used[32:], 33) if backend != "fast"]
+    assert_that(explored, is_([36, 44, 60, 92, 156]))
+    assert_that(selector.select("other", ("slow", "fast", "slower")), is_("slow"))
+
+
+def test_latency_histogram():
+    """Test percentiles of a latency histogram."""
+    histogram = lsp_utils.LatencyHistogram()
+    for seconds in (0.01, 0.01, 0.01, 1.0):
+        histogram.add(seconds)
+
+    assert_that(0.009 < histogram.percentile(0.5) < 0.012, is_(True))
+    assert_that(0.9 < histogram.percentile(1.0) < 1.2, is_(True))
+
+
+def test_get_worker_count():
+    """Test pool sizes follow the setting, or the number of processors."""
+    cpus = lsp_utils.get_cpu_count()
+
+    assert_that(lsp_utils.get_worker_count(3), is_(3))
+    assert_that(lsp_utils.get_worker_count(), is_(max(2, cpus - 1)))
+
+
+def _count_waiting(scheduler):
+    waiting = scheduler._waiting.values()  # pylint: disable=protected-access
+    return sum(len(runs) for workspaces in waiting for runs in workspaces.values())
+
+
+def test_priority_scheduler():
+    """Test slots go to batch runs first, with workspaces taking turns."""
+    scheduler = lsp_utils.PriorityScheduler(1)
+    started = []
+    threads = []
+
+    def _run(priority, workspace, name):
+        with scheduler.run(priority, workspace):
+            started.append(name)
+
+    with scheduler.run(lsp_utils.BATCH, "a"):
+        for priority, workspace, name in (
+            (lsp_utils.BACKGROUND, "a", "idle"),
+            (lsp_utils.BATCH, "a", "a1"),
+            (lsp_utils.BATCH, "a", "a2"),
+            (lsp_utils.BATCH, "b", "b1"),
+        ):
+            thread = threading.Thread(target=_run, args=(priority, workspace, name))
+            thread.start()
+            threads.append(thread)
+            # Wait until the run is queued, so that they queue in order.
+            while _count_waiting(scheduler) < len(threads):
+                time.sleep(0.01)
+    for thread in threads:
+        thread.join(10)
+
+    assert_that(started, is_(["a1", "b1", "a2", "idle"]))
+
+
+def test_priority_scheduler_preempt():
+    """Test an interactive run starts at once, cancelling a background run."""
+    scheduler = lsp_utils.PriorityScheduler(1)
+    with scheduler.run(lsp_utils.BACKGROUND, "a") as background:
+        with scheduler.run(lsp_utils.INTERACTIVE, "b") as interactive:
+            assert_that(background.cancelled.done(), is_(True))
+            assert_that(interactive.cancelled.done(), is_(False))